@@ -0,0 +1,49 @@
+import json
+import time
+import argparse
+import logging
+from lxml import etree
+from utilities.diagrams import DiagramTemplate, CompiledDiagram, generate_diagram, diagram_values, batch_geometry_params
+
+""" Compares the time to render the diagrams of a results file with the lxml path (copy, update and
+serialize the tree per point) and with the compiled renderer, and checks both outputs are identical.
+python benchmark_diagrams.py --results_path results.json --src_diagram_path 'assets/WASCOP-Resultados JJAA.svg' """
+
+logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--results_path', type=str, help='Path to a results.json file', required=True)
+parser.add_argument('--src_diagram_path', type=str, help='Path to source diagram', required=True)
+parser.add_argument('--theme', type=str, default='light', choices=['light', 'dark'])
+parser.add_argument('--max_points', type=int, default=500, help='Maximum number of operation points to render')
+args = parser.parse_args()
+
+with open(args.results_path, mode='r', encoding='utf-8') as file:
+    results = json.load(file)
+ptops = [ptop for ptops in results.values() for ptop in ptops.values()][:args.max_points]
+
+template = DiagramTemplate(args.src_diagram_path)
+
+start = time.perf_counter()
+lxml_diagrams = [etree.tostring(generate_diagram(template, ptop, theme=args.theme)) for ptop in ptops]
+lxml_time = time.perf_counter() - start
+
+start = time.perf_counter()
+renderer = CompiledDiagram(template, theme=args.theme)
+compiled_diagrams = [renderer.render(ptop) for ptop in ptops]
+compiled_time = time.perf_counter() - start
+
+# Geometry of all the points computed at once with numpy
+start = time.perf_counter()
+params = batch_geometry_params(ptops)
+batch_diagrams = [renderer.render(ptop, diagram_values(template, ptop, point_params)) for ptop, point_params in zip(ptops, params)]
+batch_time = time.perf_counter() - start
+
+for name, diagrams in [('compiled', compiled_diagrams), ('batch', batch_diagrams)]:
+    n_different = sum(a != b for a, b in zip(lxml_diagrams, diagrams))
+    if n_different:
+        logging.error(f'{n_different} of {len(ptops)} diagrams differ between the lxml and {name} renderers')
+
+logging.info(f'{len(ptops)} diagrams ({args.theme}): lxml {lxml_time:.2f} s ({len(ptops)/lxml_time:.0f} diagrams/s), '
+             f'compiled {compiled_time:.2f} s ({len(ptops)/compiled_time:.0f} diagrams/s), speedup x{lxml_time/compiled_time:.1f}, '
+             f'compiled with batch geometry {batch_time:.2f} s ({len(ptops)/batch_time:.0f} diagrams/s), speedup x{lxml_time/batch_time:.1f}')
@@ -1,17 +1,37 @@
-from copy import deepcopy
 import json
 import argparse
-import math
 import os
 import logging
 import re
-from lxml import etree
-# import xml.etree.ElementTree as ET
-# from copy import deepcopy
+import fnmatch
 import time
+import queue
+import threading
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
-import base64
+from utilities.results_store import publish_snapshot, append_to_log, load_results, atomic_write, dump_json
+from utilities.results_db import rebuild_db, update_db, DB_FILENAME
+from utilities.diagrams import DiagramTemplate, CompiledDiagram, diagram_values, batch_geometry_params, asset_cache, RENDERER_VERSION, SHARED_ASSETS_FOLDER
+from utilities.diagrams import cairosvg, render_thumbnail, thumbnail_filename, THUMBNAIL_FORMAT
+from utilities.render_queue import RenderQueue, pop_diagram_requests, is_diagram_request, report_failed_diagram, clear_failed_diagram, failed_diagrams, DIAGRAM_REQUESTS_FOLDER
+from utilities.diagram_index import parse_diagram_filename, DIAGRAMS_MANIFEST_FILENAME
+import hashlib
+import zipfile
+import tarfile
+import gzip
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    # Faster parser, optional
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # Brotli compressed diagrams, optional
+    import brotli
+except ImportError:
+    brotli = None
 
 
 # Configure logging
@@ -22,6 +42,22 @@ parser = argparse.ArgumentParser()
 parser.add_argument("--results_folder_path", help="Path to the folder where the results are saved")
 # Source svg diagram
 parser.add_argument("--src_diagram_path", help="Path to the original svg diagram")
+# Watch only the results folder, not its subfolders (saves inotify watches)
+parser.add_argument("--non_recursive", action="store_true", help="Do not watch subfolders of the results folder")
+# Parse all results files again, ignoring the manifest
+parser.add_argument("--rebuild", action="store_true", help="Rebuild the results file from scratch on the first pass")
+# Number of worker processes
+parser.add_argument("--jobs", default=os.cpu_count(), type=int, help="Number of worker processes used to parse the results files in a cold rebuild and to generate the diagrams")
+# Embed the image assets in every diagram or reference shared copies (see utilities.diagrams.AssetCache)
+parser.add_argument("--asset_mode", default='embedded', choices=['embedded', 'shared'], help="Embed the image assets in every diagram, or reference shared copies in diagrams/assets")
+# Minify the diagrams, rounding numbers to the given decimals
+parser.add_argument("--minify_precision", default=None, type=int, help="Minify the diagrams (strip editor metadata and whitespace) and round their numbers to this number of decimals")
+# Write gzip (and brotli if available) compressed copies next to every diagram
+parser.add_argument("--precompress", action="store_true", help="Also write .svg.gz and .svg.br files that the web app serves directly")
+# Diagrams rendered on demand by the web app instead
+parser.add_argument("--no_diagrams", action="store_true", help="Do not generate the diagrams, the web app renders them on demand (diagram_template_path)")
+# Raster thumbnails for small screens
+parser.add_argument("--thumbnail_widths", default=None, type=str, help="Comma separated widths (px) of raster thumbnails of the diagrams, e.g. 480,960. Requires cairosvg")
 # Generate dark variant
 parser.add_argument("--dark_variant", default=False, help="Generate dark variant", type=bool)
 # Destination svg diagram
@@ -31,515 +67,759 @@ args = parser.parse_args()
 
 """ Global vaeriables """
 
-nsmap = {
-    'sodipodi': 'http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd',
-    'cc': 'http://web.resource.org/cc/',
-    'svg': 'http://www.w3.org/2000/svg',
-    'dc': 'http://purl.org/dc/elements/1.1/',
-    'xlink': 'http://www.w3.org/1999/xlink',
-    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
-    'inkscape': 'http://www.inkscape.org/namespaces/inkscape'
-    }
+# Whenever a change is detected, action is triggered once no new changes have been detected for CHANGE_DELAY seconds
+CHANGE_DELAY = float(os.getenv("CHANGE_DELAY", default=20))  # seconds
 
-# Whenever a change is detected, action is triggered after CHANGE_DELAY seconds
-CHANGE_DELAY = os.getenv("CHANGE_DELAY", default=20)  # seconds
+# Maximum time a detected change waits before being processed, even if new changes keep arriving
+MAX_BATCH_DELAY = float(os.getenv("MAX_BATCH_DELAY", default=60))  # seconds
 
-# After an action is triggered, it cannot be triggered again until COOLDOWN_PERIOD seconds have passed
-COOLDOWN_PERIOD = os.getenv("COOLDOWN_PERIOD", default=60)  # seconds
+# A results file is only parsed once it has not been modified for FILE_SETTLE_TIME seconds,
+# files still being written are retried after that time instead of triggering a new full pass
+FILE_SETTLE_TIME = float(os.getenv("FILE_SETTLE_TIME", default=2))  # seconds
 
-logging.info(f"Loaded parameters: CHANGE_DELAY={CHANGE_DELAY} (sec), COOLDOWN_PERIOD={COOLDOWN_PERIOD} (sec)")
+# A batch that failed is processed again after ERROR_RETRY_DELAY seconds, doubled after every 
+# consecutive failure up to MAX_ERROR_RETRY_DELAY seconds
+ERROR_RETRY_DELAY = float(os.getenv("ERROR_RETRY_DELAY", default=10))  # seconds
+MAX_ERROR_RETRY_DELAY = float(os.getenv("MAX_ERROR_RETRY_DELAY", default=600))  # seconds
+
+# Number of published results snapshots that are retained
+SNAPSHOTS_TO_KEEP = int(os.getenv("SNAPSHOTS_TO_KEEP", default=5))
+
+# Number of changes appended to the results log after which they are compacted into a new snapshot
+COMPACTION_THRESHOLD = int(os.getenv("COMPACTION_THRESHOLD", default=500))
+
+# Archives of results files (ptop_*.json) that are ingested without extracting them
+ARCHIVE_PATTERNS = ['*.zip', '*.tar', '*.tar.gz', '*.tgz']
+
+# File where the state of the already processed results files is kept
+MANIFEST_FILENAME = 'results_manifest.json'
+# Cache keys of the generated diagrams, next to the diagrams folder (DIAGRAMS_MANIFEST_FILENAME), also read by the web app
+DIAGRAMS_MANIFEST_SAVE_EVERY = 100 # points
+PRECOMPRESSED_EXTENSIONS = ['.gz', '.br']
+# Diagrams submitted to every worker process at a time, the rest wait in the render queue
+DIAGRAMS_IN_FLIGHT_PER_JOB = 2
+
+logging.info(f"Loaded parameters: CHANGE_DELAY={CHANGE_DELAY} (sec), MAX_BATCH_DELAY={MAX_BATCH_DELAY} (sec), FILE_SETTLE_TIME={FILE_SETTLE_TIME} (sec), ERROR_RETRY_DELAY={ERROR_RETRY_DELAY} (sec), MAX_ERROR_RETRY_DELAY={MAX_ERROR_RETRY_DELAY} (sec), SNAPSHOTS_TO_KEEP={SNAPSHOTS_TO_KEEP}, COMPACTION_THRESHOLD={COMPACTION_THRESHOLD}")
+
+# Results kept in memory between passes: data, generation of the snapshot they are based on, number 
+# of records in its log and operating conditions changed since the snapshot
+results_state = None
 
 class MyHandler(FileSystemEventHandler):
-    def __init__(self):
-        self.last_action_time = 0
+    """ Runs in the watchdog dispatch thread, so it only enqueues the changed paths 
+    for the ResultsUpdater worker and returns """
+    
+    def __init__(self, changes_queue, results_folder_path):
+        self.changes_queue = changes_queue
+        self.results_folder_path = os.path.abspath(results_folder_path)
+        self.requests_folder = os.path.join(self.results_folder_path, DIAGRAM_REQUESTS_FOLDER)
+        
+    def is_input_file(self, path):
+        # Only ptop_*.json files, or archives of them, directly in the results folder are ingested. Anything
+        # else, including the files written by this program (results.json, manifest, diagrams/), is ignored
+        filename = os.path.basename(path)
+        return (os.path.dirname(os.path.abspath(path)) == self.results_folder_path and 
+                (fnmatch.fnmatch(filename, 'ptop_*.json') or is_archive(filename)))
+        
+    def enqueue(self, path):
+        # Diagrams requested by the web app are also passed to the worker, which renders them if it is idle
+        if self.is_input_file(path) or is_diagram_request(path, self.requests_folder):
+            self.changes_queue.put(path)
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.enqueue(event.src_path)
 
     def on_modified(self, event):
         if not event.is_directory:
-            current_time = time.time()
+            self.enqueue(event.src_path)
             
-            time.sleep(CHANGE_DELAY)
+    def on_closed(self, event):
+        if not event.is_directory:
+            self.enqueue(event.src_path)
+            
+    def on_deleted(self, event):
+        if not event.is_directory:
+            self.enqueue(event.src_path)
+            
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.enqueue(event.src_path)
+            self.enqueue(event.dest_path)
 
-            if current_time - self.last_action_time >= COOLDOWN_PERIOD:
-                logging.info(f"Detected change in {event.src_path}")
+class ResultsUpdater(threading.Thread):
+    """ Worker that coalesces bursts of changes into a single batch and processes them. 
+    Changes that arrive while a batch is being processed stay in the queue for the next one.
+    Diagrams requested by the web app while waiting for changes are rendered right away """
+    
+    def __init__(self, changes_queue):
+        super().__init__(daemon=True)
+        self.changes_queue = changes_queue
+        self.requests_folder = os.path.join(args.results_folder_path, DIAGRAM_REQUESTS_FOLDER)
+        
+    def render_requested(self):
+        # Requests that arrive during a batch are handled by it, as are those before the first one
+        if args.no_diagrams or results_state is None:
+            return
+        try:
+            generate_diagrams(results_state['data'], requested=pop_diagram_requests(self.requests_folder))
+        except Exception as e:
+            logging.error(f'Error generating the requested diagrams: {e}')
+            logging.exception(e)
+            
+    def next_change(self, deadline=None):
+        # Raises queue.Empty once the deadline (time.monotonic) passes
+        while True:
+            timeout = deadline - time.monotonic() if deadline is not None else None
+            if timeout is not None and timeout <= 0:
+                raise queue.Empty
+            path = self.changes_queue.get(timeout=timeout)
+            if not is_diagram_request(path, self.requests_folder):
+                return path
+            self.render_requested()
+        
+    def wait_for_batch(self):
+        # Block until the first change arrives
+        batch = {self.next_change()}
+        first_change_time = last_change_time = time.monotonic()
+        
+        # Keep collecting changes until CHANGE_DELAY seconds pass without new ones, 
+        # or MAX_BATCH_DELAY seconds since the first one
+        while True:
+            deadline = min(last_change_time + CHANGE_DELAY, first_change_time + MAX_BATCH_DELAY)
+            try:
+                batch.add(self.next_change(deadline))
+                last_change_time = time.monotonic()
+            except queue.Empty:
+                break
+            
+        return batch
+    
+    def retry(self, paths):
+        for path in paths:
+            self.changes_queue.put(path)
+    
+    def run(self):
+        # Process whatever is already in the results folder before waiting for changes
+        batch = {args.results_folder_path}
+        retry_delay = ERROR_RETRY_DELAY
+        
+        while True:
+            try:
+                results, pending_files = generate_results_file()
                 
-                results = generate_results_file()
-                generate_diagrams(results)
+                # Files still being written are checked again once they should have settled
+                if pending_files:
+                    logging.info(f"{len(pending_files)} files are still being written, retrying in {FILE_SETTLE_TIME} seconds")
+                    threading.Timer(FILE_SETTLE_TIME, self.retry, args=(pending_files,)).start()
+                    
+                if not args.no_diagrams:
+                    generate_diagrams(results)
+                logging.info("Functions executed")
+                retry_delay = ERROR_RETRY_DELAY
+            except Exception as e:
+                logging.error(f'Error processing changes: {e}')
+                logging.exception(e)
                 
-                self.last_action_time = current_time
+                # Otherwise the batch would wait for the next change, which may never come
+                logging.info(f"Retrying {len(batch)} changed files in {retry_delay:.0f} seconds")
+                threading.Timer(retry_delay, self.retry, args=(batch,)).start()
+                retry_delay = min(retry_delay*2, MAX_ERROR_RETRY_DELAY)
                 
-                logging.info("Functions executed")
-            else:
-                logging.info(f"Detected change in {event.src_path}, but cooldown period is not over yet, ignoring...")
-
-def generate_results_file():
-    # Join the given folder path with a default filename 'results.json'
-    results_path = os.path.join(args.results_folder_path, 'results.json')
+            batch = self.wait_for_batch()
+            logging.info(f"Detected {len(batch)} changed files, processing...")
+
+def json_loads(content):
+    if orjson is not None:
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            # orjson is stricter (e.g. NaN values are not accepted), fall back to the standard parser
+            pass
+        
+    return json.loads(content)
+
+def parse_ptop_filename(filename):
+    # Extract text from ptop_ to _R1 (not including ptop_ and _R1), and from _R1 to .json (including 
+    # _R1 but not .json). None if the filename does not have that structure
+    match = re.search(r'ptop_(.*?)_R1(.*?)\.json', filename)
+    if match is None:
+        return None
+    env_cool_req_id = match.group(1)
+    optpt_id = 'R1' + match.group(2)
+    
+    return env_cool_req_id, optpt_id
 
-    # Read existing JSON file, if it exists
-    data = {}
+def load_manifest(manifest_path, consequence='All results files will be parsed.'):
+    # The manifest keeps, for every ptop file already merged into the results, its
+    # modification time, size and content hash so unchanged files are not parsed again.
+    # None if it does not exist or can not be read, an empty manifest means no files
     try:
-        with open(results_path, 'r') as file:
-            data = json.load(file)
-            logging.info(f'File {results_path} loaded.')
+        with open(manifest_path, 'r') as file:
+            return json.load(file)
     except FileNotFoundError:
-        data = {}
-        logging.warning(f'File {results_path} not found. Creating a new one.')
+        logging.warning(f'Manifest {manifest_path} not found. {consequence}')
+    except json.JSONDecodeError:
+        logging.warning(f'Manifest {manifest_path} is corrupted. {consequence}')
         
-    # Gather all the results files in the folder that have a filename structure: 'ptop_*.json'
-    ptop_files = [f for f in os.listdir(args.results_folder_path) if os.path.isfile(os.path.join(args.results_folder_path, f)) and f.startswith('ptop_') and f.endswith('.json')]
+    return None
 
+def save_manifest(manifest, manifest_path):
+    atomic_write(manifest_path, dump_json(manifest))
 
-    for ptop_id in ptop_files:
-        # Read the results file
-        ptops_file_path = os.path.join(args.results_folder_path, ptop_id)
-        with open(ptops_file_path, 'r') as file:
-            ptop = json.load(file)
-            
-            # Check if environment and cooling requirements exist
-            # Extract text from ptop_ to _R1 (not including ptop_ and _R1)
-            env_cool_req_id = re.search(r'ptop_(.*?)_R1', ptop_id).group(1)
+def file_digest(file_path):
+    # Read in chunks, archives can be large
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            sha1.update(chunk)
             
-            if env_cool_req_id in data:
-                logging.info(f'Adding new data to operation conditions {env_cool_req_id}')
-            else:
-                logging.info(f'Creating new operation conditions {env_cool_req_id}')
-                data[env_cool_req_id] = {}
-                
-                
-            # Check if the operation point exists
-            # Extract text from _R1 to .json (including _R1 but not .json)
-            optpt_id = 'R1' + re.search(r'_R1(.*?)\.json', ptop_id).group(1)
-            
-            if optpt_id in data[env_cool_req_id]:
-                logging.info(f'Updating operation point {optpt_id}')
-            else:
-                logging.info(f'Creating new operation point {optpt_id}')
-            
-            data[env_cool_req_id][optpt_id] = ptop
-            
-        logging.debug(f'Saving operation point: {optpt_id}')
-        
-    # Write the serialized JSON to the file
-    output_path = os.path.join( args.results_folder_path, 'results.json' )
-    with open(output_path, 'w') as f:
-        json.dump(data, f, indent=4)
-        
-    logging.info(f'File {output_path} updated.')
+    return sha1.hexdigest()
+
+def is_archive(filename):
+    return any(fnmatch.fnmatch(filename, pattern) for pattern in ARCHIVE_PATTERNS)
+
+def read_archive_members(archive_path):
+    """ Streams the ptop_*.json members of a zip or tar archive, without extracting it to disk.
+    Yields (member filename, content) """
+    
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                filename = os.path.basename(info.filename)
+                if not info.is_dir() and fnmatch.fnmatch(filename, 'ptop_*.json'):
+                    yield filename, archive.read(info)
+    else:
+        # Stream mode, members are read sequentially
+        with tarfile.open(archive_path, 'r|*') as archive:
+            for member in archive:
+                filename = os.path.basename(member.name)
+                if member.isfile() and fnmatch.fnmatch(filename, 'ptop_*.json'):
+                    yield filename, archive.extractfile(member).read()
+
+def read_results_file(file_path, stat, known_hash=None):
+    """ Reads and parses a results file (a ptop_*.json file or an archive of them) given its (already 
+    obtained) stat. Returns its content hash, the operation points it contains as a list of 
+    (opcond_id, optpt_id, ptop) and a status: 'ok', 'unchanged' (same hash as known_hash), 'pending' 
+    (still being written) or 'invalid' """
+    
+    # Recently modified, it might still be being written (e.g. copied over a synced folder)
+    if time.time() - stat.st_mtime < FILE_SETTLE_TIME:
+        return None, None, 'pending'
+    
+    digest = None
+    try:
+        digest = file_digest(file_path)
         
-    return data
+        # Touched but with the same content
+        if digest == known_hash:
+            return digest, None, 'unchanged'
         
+        if is_archive(file_path):
+            points = []
+            for filename, content in read_archive_members(file_path):
+                point_id = parse_ptop_filename(filename)
+                if point_id is None:
+                    logging.error(f'Results file {filename} in archive {file_path} has no operation point in its name, ignoring it')
+                    continue
+                try:
+                    points.append( (*point_id, json_loads(content)) )
+                except json.JSONDecodeError as e:
+                    logging.error(f'Results file {filename} in archive {file_path} is not valid JSON, ignoring it: {e}')
+        else:
+            point_id = parse_ptop_filename(os.path.basename(file_path))
+            if point_id is None:
+                logging.error(f'Results file {file_path} has no operation point in its name, ignoring it until it changes')
+                return digest, None, 'invalid'
+            with open(file_path, 'rb') as file:
+                points = [ (*point_id, json_loads(file.read())) ]
+                
+        return digest, points, 'ok'
+    
+    except (json.JSONDecodeError, zipfile.BadZipFile, tarfile.TarError, EOFError, OSError) as e:
+        try:
+            if os.stat(file_path).st_mtime != stat.st_mtime:
+                # Modified while reading it
+                return None, None, 'pending'
+        except FileNotFoundError:
+            # Removed while reading it, the retry finds it gone
+            return None, None, 'pending'
         
-# Diagram generation auxiliary functions
-def round_to_nonzero_decimal(n):
-    if n == 0:
-        return 0
-    sgn = -1 if n < 0 else 1
-    scale = int(-math.floor(math.log10(abs(n))))
-    if scale <= 0:
-        scale = 1
-    factor = 10**scale
-    return sgn*math.floor(abs(n)*factor)/factor
-
-
-def convert_to_float_if_possible(value):
+        logging.error(f'Results file {file_path} is not valid, ignoring it until it changes: {e}')
+        return digest, None, 'invalid'
+    
+def parse_results_file(file_path):
+    # Used by the worker processes of the cold rebuild
     try:
-        converted_value = float(value)
-        return converted_value
-    except ValueError:
-        return value
-
-def change_text(diagram, object_id, new_text):
-    obj = diagram.xpath(f'//svg:g[@id="cell-{object_id}"]', namespaces=nsmap)
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
     
-    for child in obj[0]:
-        if child.tag.endswith('g'):
-            for child2 in child:
-                if child2.tag.endswith('text'):
-                    child2.text = new_text
-                    break
-
-    return diagram
-
-def get_y(x, xmin, xmax, ymin, ymax):
-    return ((ymax - ymin) / (xmax - xmin)) * (x - xmin) + ymin
+    digest, points, status = read_results_file(file_path, stat)
+    
+    return stat.st_mtime, stat.st_size, digest, points, status
 
-def adjust_icon(id, size, tag, value, unit, include_boundary=True, max_size=None, max_value=None):
+def rebuild_results(results_files, data):
+    """ Cold rebuild: parses every results file in a pool of worker processes and merges them 
+    into data, the results already loaded (empty to start from scratch) """
     
-    if unit=='degree_celsius': unit= '⁰C'
+    start_time = time.time()
+    manifest = {}; pending_files = []; n_points = 0
+    file_paths = [os.path.join(args.results_folder_path, filename) for filename in results_files]
     
-    for child in tag[0]:
-        # Adjust icon size
-        if 'image' in child.tag:
-            pos_x = child.get("x"); pos_y = child.get("y")
-            current_size = float(child.get("width"))
-            delta_size = size - current_size
-            
-            child.set("width", str(size))
-            child.set("height", str(size))
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        parsed = executor.map(parse_results_file, file_paths, chunksize=64)
+        
+        for filename, file_path, result in zip(results_files, file_paths, parsed):
+            if result is None:
+                continue
             
-            pos_x = float(pos_x)-delta_size/2
-            pos_y = float(pos_y)-delta_size/2
+            mtime, size, digest, points, status = result
+            if status == 'pending':
+                pending_files.append(file_path)
+                continue
             
-            child.set("x", str(pos_x))
-            child.set("y", str(pos_y))
+            manifest[filename] = {'mtime': mtime, 'size': size, 'hash': digest, 'points': []}
+            if status == 'invalid':
+                continue
             
-            # Add template-id property to be used later
-            child.set("template-id", f'icon-{id}')
+            for env_cool_req_id, optpt_id, ptop in points:
+                data.setdefault(env_cool_req_id, {})[optpt_id] = ptop
+                manifest[filename]['points'].append([env_cool_req_id, optpt_id])
+            n_points += len(points)
             
-        # Add text
-        if child.tag.endswith('g'):
-            for child2 in child:
-                if 'text' in child2.tag:
-                    if type(value) == str:
-                        child2.text = f'{value} {unit}'
-                    elif type(value) == int:
-                        child2.text = f'{value} {unit}'
-                    else:
-                        child2.text = f'{round_to_nonzero_decimal(value)} {unit}'
-                    
-    # Add boundary circle
-    if include_boundary:
-        tag[0][0].addprevious(etree.fromstring( generate_boundary_circle(id, size, max_size, max_value, pos_x, pos_y) ))
-    return tag, pos_x, pos_y
-
-def generate_boundary_circle(id, size_icon, size_boundary, max_value, pos_x, pos_y):
-    
-    x = pos_x + size_icon/2
-    y = pos_y + size_icon/2
-    
-    return f"""
-    <g id="boundary-{id}">
-        <ellipse cx="{x}" cy="{y}" rx="{size_boundary/2}" ry="{size_boundary/2}" fill-opacity="0" fill="rgb(255, 255, 255)" stroke="#ececec" stroke-dasharray="3 3" pointer-events="all"/>
-        <g fill="#ECECEC" font-family="Helvetica" font-size="10px">
-        <text x="{x+size_boundary/2}" y="{y}">{max_value:.0f}</text></g></g>
-    """
-
-def get_level(value, min_value, max_value):
-    span = max_value - min_value
-    if value < min_value + span/3:
-        level = 1
-    elif value < min_value + 2*span/3:
-        level = 2
-    else:
-        level = 3
-    return level
-
-def change_color_text(diagram, text_color, object_id):
-    obj = diagram.xpath(f'//svg:g[@id="cell-{object_id}"]',namespaces=nsmap)
-    
-    for child in obj[0]:
-        # print(child.tag)
-        if child.tag.endswith('g'):
-            # In multiline text, the color is set in the group tag
-            child.set('fill', text_color)
-            for child_ in child:
-                # print(child_.tag)
-                if 'text' in child_.tag:
-                    child_.set('fill', text_color)
-                
-    return diagram
-
-def update_image(diagram, image_path, object_id):
-
-    binary_fc       = open(image_path, 'rb').read()  # fc aka file_content
-    base64_utf8_str = base64.b64encode(binary_fc).decode('utf-8')
-
-    ext     = image_path.split('.')[-1]
-    if ext == 'svg': ext = 'svg+xml'
-    dataurl = f'data:image/{ext};base64,{base64_utf8_str}'
-
-    obj = diagram.xpath(f'//svg:g[@id="cell-{object_id}"]',namespaces=nsmap)
-
-    # print(obj[0].attrib)
-
-    for child in obj[0]:
-        if 'image' in child.tag:
-            child.set('{http://www.w3.org/1999/xlink}href', dataurl)
-                
-    return diagram
+    elapsed_time = time.time() - start_time
+    n_files = len(results_files) - len(pending_files)
+    logging.info(f'Cold rebuild: {n_files} files parsed ({n_points} operation points) into {len(data)} operation conditions in {elapsed_time:.1f} s '
+                 f'({n_files/max(elapsed_time, 1e-6):.0f} files/s, {args.jobs} processes), {len(pending_files)} pending.')
+    
+    return data, manifest, pending_files
+
+def load_results_state(results_path):
+    # Current snapshot plus its log
+    loaded = load_results(args.results_folder_path)
+    if loaded is not None:
+        data, generation, n_log_records, changed_opcond_ids = loaded
+        logging.info(f'Results snapshot {generation} loaded ({n_log_records} changes in its log).')
+        return {'data': data, 'generation': generation, 'n_log_records': n_log_records, 'changed_opcond_ids': changed_opcond_ids}
+    
+    # Nothing published yet, results.json from a previous version if it exists
+    try:
+        with open(results_path, 'rb') as file:
+            data = json_loads(file.read())
+            logging.info(f'File {results_path} loaded.')
+    except FileNotFoundError:
+        logging.warning(f'File {results_path} not found. Creating a new one.')
+        return None
+    
+    return {'data': data, 'generation': 0, 'n_log_records': 0, 'changed_opcond_ids': set(data.keys())}
 
-def generate_diagram(diagram, ptop, theme='light'):
+def compact_results(results_path):
+    """ Folds the changes in the results log into a new snapshot, only the shards of the operating 
+    conditions that changed are written. results.json is also refreshed """
     
-    # Extract assets folder from the original diagram path
-    folder_path = os.path.dirname(args.src_diagram_path) 
+    data = results_state['data']
+    write_results_file(data, results_path)
     
-    # Líneas
-    lineas = ["line_c_in", "line_c_out", "line_r1", "line_dc_in", "line_dc_out",
-              "line_r2_out1", "line_r2_out2", "line_wct_in", "line_wct_out", "line_pump_in"]
+    results_state['generation'] = publish_snapshot(args.results_folder_path, data, results_state['changed_opcond_ids'], 
+                                                   snapshots_to_keep=SNAPSHOTS_TO_KEEP)
+    results_state['n_log_records'] = 0
+    results_state['changed_opcond_ids'] = set()
 
-    line_c_max = 15
-    line_c_min = 10
+def generate_results_file():
+    global results_state
+    
+    # Join the given folder path with a default filename 'results.json'
+    results_path = os.path.join(args.results_folder_path, 'results.json')
+    manifest_path = os.path.join(args.results_folder_path, MANIFEST_FILENAME)
 
-    # Iconos
-    iconos = ["cost_e_dc", "cost_e_wct", "cost_w_wct", "cooling_req", "fan_dc", 
-              "fan_wct", "temp_amb", "hr_amb", "temp_dc", "temp_wct", "valve_r1",
-              "valve_r2"]
+    if results_state is None:
+        results_state = load_results_state(results_path)
+        
+    if results_state is not None:
+        data = results_state['data']
+        manifest = load_manifest(manifest_path)
+    else:
+        data = {}
+        # Without previous results the manifest is meaningless, every file needs to be parsed again
+        manifest = None
+        
+    # Gather all the results files in the folder: files with a filename structure 'ptop_*.json' and archives of them
+    results_files = [f for f in os.listdir(args.results_folder_path) if os.path.isfile(os.path.join(args.results_folder_path, f)) and 
+                     ((f.startswith('ptop_') and f.endswith('.json')) or is_archive(f))]
+    
+    # Nothing known about the existing files (fresh start, no manifest yet or --rebuild). The results 
+    # already loaded are kept, points without a results file included, unless rebuilding from scratch
+    if manifest is None or args.rebuild:
+        data, manifest, pending_files = rebuild_results(results_files, {} if args.rebuild else data)
+        args.rebuild = False
+        
+        # Every shard is written again
+        results_state = {'data': data, 'generation': None, 'n_log_records': 0, 'changed_opcond_ids': None}
+        compact_results(results_path)
+        rebuild_db(os.path.join(args.results_folder_path, DB_FILENAME), data)
+        save_manifest(manifest, manifest_path)
+        
+        return data, pending_files
 
-    # Cuadros de texto
-    textos = ["line_c_in_text", "line_c_out_text", "pump_c_text"]
+    n_new = 0; n_updated = 0; n_deleted = 0; n_skipped = 0
+    pending_files = []
+    log_records = []
+    manifest_changed = not os.path.exists(manifest_path)
     
-    # Define some short names
-    op_r = ptop["operating_range"]
-    dv = ptop["decision_variables"]
+    # Points of deleted or updated files that might need to be removed
+    removed_points = set()
     
-    # Get objects to update in diagram
-    tags = {}
-    for object_ in lineas + iconos + textos:
-        tags[object_] = diagram.xpath(f'//svg:g[@id="cell-{object_}"]',namespaces=nsmap)
+    # Remove operation points whose results file no longer exists. Done before parsing so that 
+    # a renamed file is not removed right after being added again
+    for filename in set(manifest.keys()) - set(results_files):
+        entry = manifest.pop(filename)
+        removed_points.update((env_cool_req_id, optpt_id) for env_cool_req_id, optpt_id in entry.get('points', []))
+        manifest_changed = True
+
+    for filename in results_files:
+        file_path = os.path.join(args.results_folder_path, filename)
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            # Removed after listing the folder, its deletion event will trigger a new pass
+            continue
+        entry = manifest.get(filename)
         
-        if not tags[object_]:
-            raise ValueError(f'Object {object_} not found in diagram')
+        # Skip files that have not changed since they were last merged
+        if entry is not None and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+            n_skipped += 1
+            continue
         
-    # Modificar grosor de líneas
-
-    x = dv["qc"]; xmin = op_r["qc_min"]; xmax = op_r["qc_max"]; ymin = line_c_min; ymax = line_c_max
-    line_width = get_y(x, xmin, xmax, ymin, ymax)
-    for line in ["line_pump_in", "line_c_in", "line_c_out"]:
-        tag = tags[line]
+        digest, points, status = read_results_file(file_path, stat, known_hash=entry['hash'] if entry else None)
         
-        # Línea y flecha
-        for child in tag[0]:
-            child.set("stroke-width", str(line_width))
-            
-    tag = tags["line_r1"]
-    width_line_r1 = line_width*(dv["R1"])
-    # Línea y flecha
-    for child in tag[0]:
-        child.set("stroke-width", str(width_line_r1))
-
-    width_line_dc = line_width*(1-dv["R1"])
-    for line in ["line_dc_in", "line_dc_out"]:
-        tag = tags[line]
-        # Línea y flecha
-        for child in tag[0]:
-            child.set("stroke-width", str(width_line_dc))
-
-    tag = tags["line_r2_out1"]
-    width_r2_out1 = width_line_dc*(1-dv["R2"])
-    # Línea y flecha
-    for child in tag[0]:
-        child.set("stroke-width", str(width_r2_out1))        
-            
-    tag = tags["line_r2_out2"]
-    width_line_r2_out2 = width_line_dc*(dv["R2"])
-    # Línea y flecha
-    for child in tag[0]:
-        child.set("stroke-width", str(width_line_r2_out2))    
+        if status == 'pending':
+            pending_files.append(file_path)
+            continue
+        
+        manifest_changed = True
+        if status == 'unchanged':
+            entry.update({'mtime': stat.st_mtime, 'size': stat.st_size})
+            n_skipped += 1
+            continue
+        if status == 'invalid':
+            # Previous data, if any, is kept
+            manifest[filename] = {'points': [], **(entry or {}), 'mtime': stat.st_mtime, 'size': stat.st_size, 'hash': digest}
+            continue
+        
+        for env_cool_req_id, optpt_id, ptop in points:
+            # Check if environment and cooling requirements exist
+            if env_cool_req_id not in data:
+                logging.debug(f'Creating new operation conditions {env_cool_req_id}')
+                data[env_cool_req_id] = {}
                 
-    for line in ["line_wct_in", "line_wct_out"]:
-        tag = tags[line]
-        # Línea y flecha
-        for child in tag[0]:
-            child.set("stroke-width", str(width_line_r1 + width_line_r2_out2) )
-    
-    # Modificar tamaño de iconos y añadir template-id para texto
-
-    # ["cost_e_dc", "cost_e_wct", "cost_w_wct", "cooling_req", "fan_dc", 
-    #  "fan_wct", "temp_amb", "hr_amb", "temp_wct", "temp_dc", "valve_r1",
-    #  "valve_r2"]
-
-    # tag_copy = deepcopy(tags)
-
-    max_size = 70
-    min_size = 30
-
-    icon_ids= ["fan_dc", "fan_wct", "valve_r1", "valve_r2", "temp_amb", "hr_amb", "temp_wct", "temp_dc"]
-    var_ids = ["w_fan_dc", "w_fan_wct", "R1", "R2", "Tamb", "HR", "Twct_out", "Tdc_out"]
-    groups  = ["control_variables", "control_variables", "decision_variables", "decision_variables", "environment", "environment", "decision_variables", "decision_variables"]
-    units   = ["%", "%", "", "", "degree_celsius", "%", "degree_celsius", "degree_celsius"]
-    boundaries= [True,      True,      False,      False,      True,       True,     True, True]
-
-    # Costes máximos y mínimos obtenidos a partir de resultados de optimización
-    # Min=1e6; for i=1:2, for j=1:2, min_=min(results_total{i,j}.Pe); if min_<Min, Min=min_; end, end, end, disp(Min)
-    # Max=1e-6; for i=1:2, for j=1:2, max_=max(results_total{i,j}.Pe); if max_>Max, Max=max_; end, end, end, disp(Max)
-
-    # max_values = []
-    # pos_xs = []; pos_ys = []
-    for var_id, icon_id, group, unit, boundary in zip(var_ids, icon_ids, groups, units, boundaries):
-        
-        tag = tags[icon_id]; id_ = var_id
-        x = ptop[group][id_]
-        xmin = op_r[id_+'_min']; xmax = op_r[id_+'_max']; ymin = min_size; ymax = max_size
-        size = get_y(x, xmin, xmax, ymin, ymax)
-        
-        logging.debug(f'var_id: {var_id}, icon_id: {icon_id}, group: {group}, unit: {unit}, value: {ptop[group][id_]}')
-        
-        # max_values.append(xmax)
-        tag = adjust_icon(id_, size, tag, convert_to_float_if_possible(ptop[group][id_]), 
-                          unit, include_boundary=boundary, max_size=max_size, max_value=xmax)
-        # pos_xs.append(pos_x); pos_ys.append(pos_y)
-        
-    # Añadir valores para cuadros de texto
-
-    # ["line_c_in_text", "line_c_out_text", "pump_c_text"]
-
-    for text_box, var_id, group, unit in zip(["line_c_in_text", "line_c_out_text", "pump_c_text"], 
-                                             ["Tc_in", "Tc_out", "qc"],
-                                             ["others", "others", "decision_variables"],
-                                             ["°C", "°C", "m3/h"]):
-        
-        tag = tags[text_box]
-        for child in tag[0]:
-            if child.tag.endswith('g'):
-                for child2 in child:
-                    if 'text' in child2.tag:
-                        if unit == 'degree_celsius': unit = '⁰C'
-                        
-                        child2.text = f'{round_to_nonzero_decimal( ptop[group][var_id] )} {unit}'
+            # Check if the operation point exists
+            if optpt_id in data[env_cool_req_id]:
+                logging.debug(f'Updating operation point {optpt_id} of operation conditions {env_cool_req_id}')
+                n_updated += 1
+            else:
+                logging.debug(f'Creating new operation point {optpt_id} of operation conditions {env_cool_req_id}')
+                n_new += 1
             
+            data[env_cool_req_id][optpt_id] = ptop
+            log_records.append({'op': 'put', 'opcond_id': env_cool_req_id, 'optpt_id': optpt_id, 'ptop': ptop})
             
-    # Cooling requirements
-    icon_id = 'cooling_req'
-    tag = tags[icon_id];
-
-    cr = ptop["cooling_requirements"]
-
-    x = cr['Pth'] 
-    xmin = op_r['Pth_min']; xmax = op_r['Pth_max']
-    ymin = min_size; ymax = max_size
-    size = get_y(x, xmin, xmax, ymin, ymax)
-    value = f'{x:.0f} kWhth, {cr["Mv"]:.2f} kg/s, {cr["Tv"]:.0f} ⁰C'
-
-    tag = adjust_icon('cooling_req', size, tag, value, unit='', include_boundary=True, max_size=max_size, max_value=xmax)
-    
-    # Costs icons and text values
-    min_value = op_r['Ce_min']
-    max_value = op_r['Ce_max']
-
-    value = ptop['costs']['Ce_wct']
-    level = get_level(value, min_value, max_value)
-    image_path = os.path.join(folder_path, f'electrical_consumption_x{level}.svg')
-    diagram = update_image(diagram, image_path, object_id='cost_e_wct')
-    tag = tags['cost_e_wct']
-    tag = adjust_icon('Ce_wct', 70, tag, value, 'kWhe', include_boundary=False, max_size=None, max_value=None)
-
-    value = ptop['costs']['Ce_dc']
-    level = get_level(value, min_value, max_value)
-    image_path = os.path.join(folder_path, f'electrical_consumption_x{level}.svg')
-    diagram = update_image(diagram, image_path, object_id='cost_e_dc')
-    tag = tags['cost_e_dc']
-    tag = adjust_icon('Ce_dc', 70, tag, value, 'kWhe', include_boundary=False, max_size=None, max_value=None)
-
-    min_value = 0
-    max_value = op_r['Cw_max']
-    value = ptop['costs']['Cw_wct']
-    level = get_level(value, min_value, max_value)
-    image_path = os.path.join(folder_path, f'water_consumption_x{level}.svg')
-    diagram = update_image(diagram, image_path, object_id='cost_w_wct')
-    tag = tags['cost_w_wct']
-    tag = adjust_icon('Cw_wct', 70, tag, value, 'L/h', include_boundary=False, max_size=None, max_value=None)
-    
-    # Change text for additional variables
-    object_ids = ['Twct_in', 'qwct', 'qdc']
-    values = [ptop['others']['Twct_in'], ptop['others']['m_wct'], ptop['others']['m_dc']]
-    units  = ['°C', 'm³/h', 'm³/h']
-
-    for object_id, value, unit in zip(object_ids, values, units):
-        diagram = change_text(diagram, object_id, f'{round_to_nonzero_decimal(value)} {unit}')
-    
-    # Change background depending on theme
-    if theme=='dark':
-        
-        # Background image
-        image_path = os.path.join(folder_path, 'background_dark.jpg')
-        diagram = update_image(diagram, image_path, object_id='background-image')           
-        # Logo gobierno
-        image_path = os.path.join(folder_path, 'micin-uefeder-aei_letras_blancas.svg')
-        diagram = update_image(diagram, image_path, object_id='logo-gobierno')      
-        # Logo PSA
-        image_path = os.path.join(folder_path, 'logo_psa_letras_blancas_sin_fondo.svg')
-        diagram = update_image(diagram, image_path, object_id='logo-psa')
-        
-        # Symbols legend box
-        for i in range(28, 57):
-            symbols_obj = diagram.xpath(f'//svg:g[@id="cell-juWprjBz31KtaNW54uK3-{i}"]',namespaces=nsmap)
-
-            if len(symbols_obj) == 0:
-                continue
+        # Points no longer present in an updated archive are removed at the end
+        new_points = [[env_cool_req_id, optpt_id] for env_cool_req_id, optpt_id, _ in points]
+        if entry is not None:
+            removed_points.update((env_cool_req_id, optpt_id) for env_cool_req_id, optpt_id in entry.get('points', []))
+            
+        manifest[filename] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'hash': digest, 'points': new_points}
+        
+    # Points no longer provided by any results file (a point could be in both a ptop file and an archive)
+    provided_points = {(env_cool_req_id, optpt_id) for entry in manifest.values() for env_cool_req_id, optpt_id in entry.get('points', [])} if removed_points else set()
+    for env_cool_req_id, optpt_id in removed_points - provided_points:
+        if optpt_id in data.get(env_cool_req_id, {}):
+            logging.debug(f'Removing operation point {optpt_id} from operation conditions {env_cool_req_id}')
+            del data[env_cool_req_id][optpt_id]
+            if not data[env_cool_req_id]:
+                del data[env_cool_req_id]
+            log_records.append({'op': 'del', 'opcond_id': env_cool_req_id, 'optpt_id': optpt_id})
+            n_deleted += 1
+    
+    logging.info(f'Results files: {len(results_files) - n_skipped - len(pending_files)} parsed, {n_skipped} unchanged (skipped), {len(pending_files)} pending. '
+                 f'Operation points: {n_new} new, {n_updated} updated, {n_deleted} deleted.')
+    
+    results_state['changed_opcond_ids'].update(record['opcond_id'] for record in log_records)
+    
+    if results_state['generation'] == 0:
+        # Nothing published yet (results.json from a previous version)
+        compact_results(results_path)
+    elif log_records:
+        # Only the changes are written, appended to the log of the current snapshot
+        append_to_log(args.results_folder_path, results_state['generation'], log_records)
+        results_state['n_log_records'] += len(log_records)
+        logging.info(f'{len(log_records)} changes appended to the results log.')
+        
+        if results_state['n_log_records'] >= COMPACTION_THRESHOLD:
+            compact_results(results_path)
             
-            # print(symbols_obj[0].attrib)
+    # Operation points database
+    db_path = os.path.join(args.results_folder_path, DB_FILENAME)
+    if not os.path.exists(db_path):
+        rebuild_db(db_path, data)
+    elif log_records:
+        update_db(db_path, log_records)
+    
+    # Saved after the results so that, if interrupted, the files are parsed again in the next pass
+    if manifest_changed:
+        save_manifest(manifest, manifest_path)
+        
+    return data, pending_files
 
-            for child in symbols_obj[0]:
-                # print(child.tag)
-                
-                # Update background color
-                if 'rect' in child.tag and len(symbols_obj[0]) == 1:
-                    # print('changing background of legend box')
-                    child.set('fill', '#333333')
-                    child.set('stroke', '#ECECEC')
-                    
-                    
-                # Change text color
-                if 'g' in child.tag and not 'rect' in child.tag:
-                    for child_ in child:
-                        if 'text' in child_.tag:
-                            child_.set('fill', '#ECECEC')
-               
-        # Title
-        diagram = change_color_text(diagram, text_color='#ECECEC', object_id='titulo')
+def write_results_file(data, output_path):
+    # Compact form, the file is only meant to be read by programs
+    atomic_write(output_path, dump_json(data))
+        
+    logging.info(f'File {output_path} updated.')
+        
+        
+# Renderers of the diagram worker processes (or of the updater itself when a single job is used)
+diagram_renderers = {}
 
-        # Subtitle
-        diagram = change_color_text(diagram, text_color='#ECECEC', object_id='subtitulo')
+def init_diagram_worker(src_diagram_path, dark_variant, shared_assets_folder=None, precision=None):
+    # Every worker loads and compiles the source diagram once
+    template = DiagramTemplate(src_diagram_path)
+    asset_cache.shared_folder = shared_assets_folder
+    
+    diagram_renderers.clear()
+    diagram_renderers[''] = CompiledDiagram(template, precision=precision)
+    if dark_variant:
+        diagram_renderers['_dark'] = CompiledDiagram(template, theme='dark', precision=precision)
+
+def precompress_diagram(content):
+    # Served as they are to clients that accept the encoding
+    variants = {'.gz': gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['.br'] = brotli.compress(content, quality=11)
+    return variants
+
+def render_diagram_files(output_folder, ptop_id, ptop, suffixes, params=None, precompress=False, thumbnail_widths=()):
+    """ Renders and writes the given variants of the diagram of an operation point. Returns an error 
+    message or None, and the bytes written by type ('.svg', '.gz', '.br', 'thumbnails') and saved by the minification """
+    
+    try:
+        # The values of the point are computed once and shared by every variant
+        values = diagram_values(diagram_renderers[''].template, ptop, params, diagram_renderers[''].precision)
+        diagrams = {suffix: diagram_renderers[suffix].render(ptop, values) for suffix in suffixes}
+    except Exception as e:
+        return f'{type(e).__name__}: {e}', {}
+    
+    # Only written once all variants are rendered, and atomically so a diagram is never left half written
+    sizes = {'.svg': 0, '.gz': 0, '.br': 0, 'thumbnails': 0, 'minified': 0}
+    for suffix, diagram in diagrams.items():
+        diagram_path = os.path.join(output_folder, f'{ptop_id}{suffix}.svg')
+        atomic_write(diagram_path, diagram)
+        sizes['.svg'] += len(diagram)
+        sizes['minified'] += diagram_renderers[suffix].saved_bytes
         
-    return diagram
+        # Written after the diagram, so they are never older than it
+        variants = precompress_diagram(diagram) if precompress else {}
+        for ext in PRECOMPRESSED_EXTENSIONS:
+            if ext in variants:
+                atomic_write(diagram_path + ext, variants[ext])
+                sizes[ext] += len(variants[ext])
+            elif os.path.exists(diagram_path + ext):
+                # Would be served instead of the new diagram
+                os.remove(diagram_path + ext)
+                
+        # The app only uses thumbnails that are not older than their diagram
+        for width in thumbnail_widths:
+            try:
+                thumbnail = render_thumbnail(diagram, width, url=diagram_path)
+            except Exception as e:
+                logging.error(f'Error generating the {width} px thumbnail of {diagram_path}: {type(e).__name__}: {e}')
+                continue
+            atomic_write(os.path.join(output_folder, thumbnail_filename(f'{ptop_id}{suffix}.svg', width)), thumbnail)
+            sizes['thumbnails'] += len(thumbnail)
         
-def generate_diagrams(results):
+    return None, sizes
+
+def diagram_key(ptop, template_hash, theme, output_options):
+    # A diagram only changes if the operation point, the source diagram or its assets, the theme, the output options (asset mode, 
+    # minification) or the renderer do
+    content = json.dumps(ptop, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return hashlib.sha1(f'{RENDERER_VERSION}:{template_hash}:{theme}:{output_options}:'.encode('utf-8') + content).hexdigest()
+
+def generate_diagrams(results, requested=None):
+    """ Generates the diagrams of the operation points that are not up to date, or only those of the 
+    requested ptop_ids (<opcond_id>_<ptop_id>) when the web app asks for them between batches """
+    
+    if requested is not None and not requested:
+        return
 
-    diagram_file = args.src_diagram_path
     output_folder = os.path.join(args.results_folder_path, 'diagrams')
+    os.makedirs(output_folder, exist_ok=True)
+    manifest_path = os.path.join(args.results_folder_path, DIAGRAMS_MANIFEST_FILENAME)
     
-    # Load source diagram
-    with open(diagram_file, 'r') as f:
-        diagram = etree.parse(f)
+    # Load and validate source diagram
+    shared_assets_folder = os.path.join(output_folder, SHARED_ASSETS_FOLDER) if args.asset_mode == 'shared' else None
+    init_diagram_worker(args.src_diagram_path, args.dark_variant, shared_assets_folder, args.minify_precision)
+    output_options = f'{args.asset_mode}:{args.minify_precision}'
+    
+    thumbnail_widths = [int(width) for width in args.thumbnail_widths.split(',')] if args.thumbnail_widths else []
+    if thumbnail_widths and cairosvg is None:
+        logging.warning('cairosvg is not installed, diagram thumbnails will not be generated.')
+        thumbnail_widths = []
+    template_hash = diagram_renderers[''].template.hash
         
-    # From the results file, identify operation points which already have a generated diagram
-    existing_diagram_files = os.listdir(output_folder)
-
-    # Iterate over the operation points
-    for op_cond in results:
-        for ptop_ in results[op_cond]:
-            ptop_id = f'{op_cond}_{ptop_}'
-            
-            if ptop_id in existing_diagram_files:
-                logging.info(f'Diagram for operation point {ptop_id} already exists. Not generating a new one.')
+    # Diagrams whose file exists and was generated from the same inputs are not generated again. 
+    # The manifest keeps the key of every diagram file: {filename: key}
+    manifest = load_manifest(manifest_path, 'All diagrams will be generated.') or {}
+    existing_diagram_files = set(os.listdir(output_folder))
+    
+    # Points that failed before are reported to the web app until they are rendered
+    requests_folder = os.path.join(args.results_folder_path, DIAGRAM_REQUESTS_FOLDER)
+    failed_ptop_ids = failed_diagrams(requests_folder)
+    
+    if requested is None:
+        points = [(op_cond, ptop_) for op_cond in results for ptop_ in results[op_cond]]
+    else:
+        points = []
+        for ptop_id in requested:
+            diagram_id = parse_diagram_filename(f'{ptop_id}.svg')
+            if diagram_id is None or diagram_id[0] not in results or diagram_id[1] not in results[diagram_id[0]]:
+                # Not in the results yet, rendered by the batch that adds it
+                logging.info(f'Diagram for operation point {ptop_id} requested, but it is not in the results.')
                 continue
-            
-            ptop = results[op_cond][ptop_]
-            
-            try:
-                diagram_copy = deepcopy(diagram)
-                diagram_light = generate_diagram(diagram_copy, ptop)
-                
-                if args.dark_variant:
-                    diagram_copy = deepcopy(diagram)
-                    diagram_dark = generate_diagram(diagram_copy, ptop, theme='dark')
+            points.append(diagram_id[:2])
+
+    pending_points = []; n_skipped = 0
+    for op_cond, ptop_ in points:
+        ptop_id = f'{op_cond}_{ptop_}'
+        ptop = results[op_cond][ptop_]
+        
+        keys = {}
+        for suffix, renderer in diagram_renderers.items():
+            filename = f'{ptop_id}{suffix}.svg'
+            key = diagram_key(ptop, template_hash, renderer.theme, output_options)
+            if (manifest.get(filename) != key or filename not in existing_diagram_files or 
+                (args.precompress and f'{filename}.gz' not in existing_diagram_files) or
+                any(thumbnail_filename(filename, width) not in existing_diagram_files for width in thumbnail_widths)):
+                keys[suffix] = key
+        
+        if not keys:
+            n_skipped += 1
+            continue
+        
+        pending_points.append((ptop_id, ptop, keys))
+        
+    logging.info(f'Diagrams up to date for {n_skipped} operation points, {len(pending_points)} to generate{" (requested)" if requested is not None else ""}.')
+    if not pending_points:
+        # Requests for diagrams that are already up to date
+        if requested is None:
+            pop_diagram_requests(requests_folder)
+        return
+    
+    start_time = time.time()
+    n_errors = 0; n_unsaved = 0
+    sizes = {'.svg': 0, '.gz': 0, '.br': 0, 'thumbnails': 0, 'minified': 0}
+    
+    # Geometry and labels of all the points computed at once, those it is None for are computed (and fail) on their own
+    params = batch_geometry_params([ptop for _, ptop, _ in pending_points])
+    
+    def record_result(ptop_id, keys, error, point_sizes):
+        nonlocal n_errors, n_unsaved
+        
+        if error is not None:
+            logging.error(f'Error generating diagram for operation point {ptop_id}: {error}')
+            n_errors += 1
+            # Otherwise the web app would wait for it forever
+            report_failed_diagram(requests_folder, ptop_id)
+            return
+        
+        if ptop_id in failed_ptop_ids:
+            clear_failed_diagram(requests_folder, ptop_id)
+        for size_type, size in point_sizes.items():
+            sizes[size_type] += size
+        for suffix, key in keys.items():
+            manifest[f'{ptop_id}{suffix}.svg'] = key
+        logging.info(f'Diagram for operation point {ptop_id} generated{" (and its dark variant)" if "_dark" in keys else ""}.')
+        
+        # Saved along the way so an interrupted batch resumes where it stopped
+        n_unsaved += 1
+        if n_unsaved >= DIAGRAMS_MANIFEST_SAVE_EVERY:
+            save_manifest(manifest, manifest_path)
+            n_unsaved = 0
+    
+    # Points are rendered in batch order, except those requested by the web app (see utilities.render_queue)
+    render_queue = RenderQueue()
+    for (ptop_id, ptop, keys), point_params in zip(pending_points, params):
+        render_queue.push(ptop_id, (ptop, keys, point_params))
+    
+    n_jobs = min(args.jobs, len(pending_points))
+    try:
+        if n_jobs <= 1:
+            while render_queue:
+                render_queue.bump_requested(requests_folder)
+                ptop_id, (ptop, keys, point_params) = render_queue.pop()
+                record_result(ptop_id, keys, *render_diagram_files(output_folder, ptop_id, ptop, list(keys), point_params, 
+                                                                   args.precompress, thumbnail_widths))
+        else:
+            # Each point is written as soon as it is rendered, a point that fails does not affect the rest. Only a few 
+            # points per worker are submitted at a time so that requested points do not wait behind the whole batch
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=init_diagram_worker,
+                                     initargs=(args.src_diagram_path, args.dark_variant, shared_assets_folder, args.minify_precision)) as executor:
+                futures = {}
+                while render_queue or futures:
+                    render_queue.bump_requested(requests_folder)
+                    while render_queue and len(futures) < n_jobs * DIAGRAMS_IN_FLIGHT_PER_JOB:
+                        ptop_id, (ptop, keys, point_params) = render_queue.pop()
+                        future = executor.submit(render_diagram_files, output_folder, ptop_id, ptop, list(keys), point_params, 
+                                                 args.precompress, thumbnail_widths)
+                        futures[future] = (ptop_id, keys)
                     
-            except Exception as e:
-                logging.error(f'Error generating diagram for operation point {ptop_id}.')
-                logging.error(e)
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        try:
+                            error, point_sizes = future.result()
+                        except Exception as e:
+                            # e.g. the worker process died
+                            error, point_sizes = f'{type(e).__name__}: {e}', {}
+                        record_result(*futures.pop(future), error, point_sizes)
+    finally:
+        if n_unsaved:
+            save_manifest(manifest, manifest_path)
                 
-            
-            with open(os.path.join(output_folder, ptop_id+'.svg'), 'w') as diagram_file:
-                diagram_file.write( etree.tostring(diagram_light).decode() )
-                
-            logging.info(f'Diagram for operation point {ptop_id} generated.')
-            
-            if args.dark_variant:
-                with open(os.path.join(output_folder, ptop_id+'_dark.svg'), 'w') as diagram_file:
-                    diagram_file.write( etree.tostring(diagram_dark).decode() )
-                    
-                logging.info(f'Dark variant of diagram for operation point {ptop_id} generated.')
-        
+    elapsed_time = time.time() - start_time
+    logging.info(f'Generated diagrams for {len(pending_points) - n_errors} operation points in {elapsed_time:.1f} s '
+                 f'({len(pending_points)/max(elapsed_time, 1e-6):.0f} points/s, {max(n_jobs, 1)} processes), {n_errors} errors.')
+    
+    size_report = f'{sizes[".svg"]/1e3:.0f} kB of svg written'
+    if args.minify_precision is not None:
+        size_report += f', {sizes["minified"]/1e3:.0f} kB saved by the minification'
+    if args.precompress:
+        size_report += f', {sizes[".gz"]/1e3:.0f} kB gzip ({1 - sizes[".gz"]/max(sizes[".svg"], 1):.0%} saved)'
+        if brotli is not None:
+            size_report += f', {sizes[".br"]/1e3:.0f} kB brotli ({1 - sizes[".br"]/max(sizes[".svg"], 1):.0%} saved)'
+    if thumbnail_widths:
+        size_report += f', {sizes["thumbnails"]/1e3:.0f} kB of {THUMBNAIL_FORMAT} thumbnails'
+    logging.info(f'{size_report}.')
     
     
 if __name__ == '__main__':
     # Run program indefinitevily, watching for changes in folder and subfolders of results_folder_path, and then trigger functions
     
-    event_handler = MyHandler()
+    changes_queue = queue.Queue()
+    updater = ResultsUpdater(changes_queue)
+    
+    event_handler = MyHandler(changes_queue, args.results_folder_path)
     observer = Observer()
-    observer.schedule(event_handler, path=args.results_folder_path, recursive=True)
+    observer.schedule(event_handler, path=args.results_folder_path, recursive=not args.non_recursive)
+    if args.non_recursive:
+        # Diagram requests of the web app are still watched
+        os.makedirs(event_handler.requests_folder, exist_ok=True)
+        observer.schedule(event_handler, path=event_handler.requests_folder, recursive=False)
     observer.start()
     logging.info(f"Watching {args.results_folder_path} for changes...")
+    
+    # Started once the folder is watched, so files written during the first pass are not missed
+    updater.start()
 
     try:
         while True:
@@ -13,9 +13,19 @@ import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import random
 from flask_caching import Cache
+import flask
+import mimetypes
+import logging
+import hashlib
+from werkzeug.exceptions import NotFound, UnprocessableEntity
 
 # with open('webpage.hjson', mode="r", encoding='utf-8') as file: config = hjson.loads(file.read())
 from utilities import globals
+from utilities.results_store import ResultsStore
+from utilities.diagrams import thumbnail_filename, asset_cache, THUMBNAIL_FORMATS, SHARED_ASSETS_FOLDER
+from utilities.diagram_cache import DiagramCache
+from utilities.render_queue import request_diagram, is_diagram_failed
+from utilities.diagram_index import DiagramIndex, parse_diagram_filename, diagram_filename, versioned_filename, unversioned_filename, DIAGRAMS_MANIFEST_FILENAME
 
 """ Globals """
 app = dash.get_app()
@@ -42,8 +52,8 @@ dash.register_page(
     image="assets/logo.png",
 )
 
-with open(config["pareto_results_path"], mode="r", encoding='utf-8') as file: 
-    results = json.loads(file.read())
+# Results are split in one shard per operating condition, loaded the first time they are requested
+results = ResultsStore(os.path.dirname(config["pareto_results_path"]))
 
 CACHE_TYPE = os.getenv("CACHE_TYPE", default=None)
 if  CACHE_TYPE == "redis":
@@ -70,6 +80,98 @@ elif CACHE_TYPE == 'local':
 else:
     cache = Cache(app.server, config={"CACHE_TYPE": "null"})
 
+# Generated diagrams, served by the app so the compressed copies written by the updater 
+# (generate_results.py --precompress) are sent as they are to the clients that accept them
+diagram_path = config.get("diagrams_path", os.path.join('assets', 'optimization_V1', 'diagrams'))
+diagrams_url = f'{config.get("url_base_pathname", "/")}diagrams/'
+
+# Diagrams not generated by the updater are rendered on demand if the source diagram is configured
+if config.get("diagram_template_path"):
+    if config.get("diagram_asset_mode", "embedded") == "shared":
+        asset_cache.shared_folder = os.path.join(diagram_path, SHARED_ASSETS_FOLDER)
+    diagram_cache = DiagramCache(config["diagram_template_path"], max_bytes=config.get("diagram_cache_mb", 64)*1024*1024,
+                                 precision=config.get("diagram_minify_precision"))
+else:
+    diagram_cache = None
+    
+# Otherwise, the updater is asked to render them first (<results folder>/diagram_requests, see utilities.render_queue)
+diagram_requests_path = config.get("diagram_requests_path")
+
+# Available diagrams and their versions, so their urls change with their content and browsers can keep them
+diagram_index = DiagramIndex(diagram_path, config.get("diagrams_manifest_path", 
+                                                      os.path.join(os.path.dirname(os.path.normpath(diagram_path)), DIAGRAMS_MANIFEST_FILENAME)))
+
+def diagram_url(filename):
+    """ Url of a diagram or of one of its thumbnails, with the version of its content if it is known """
+    
+    version = diagram_index.get_version_by_filename(filename)
+    return diagrams_url + (versioned_filename(filename, version) if version else filename)
+
+def render_diagram_on_demand(filename):
+    diagram_id = parse_diagram_filename(filename)
+    if diagram_cache is None or diagram_id is None:
+        raise NotFound()
+    
+    opcond_id, ptop_id, theme = diagram_id
+    if opcond_id not in results or ptop_id not in results[opcond_id]:
+        raise NotFound()
+    
+    diagram = diagram_cache.get(opcond_id, ptop_id, results[opcond_id][ptop_id], theme=theme)
+    if diagram is None:
+        # The operation point is missing values the diagram needs
+        raise UnprocessableEntity()
+    
+    response = flask.Response(diagram, mimetype='image/svg+xml')
+    response.set_etag(hashlib.sha1(diagram).hexdigest())
+    return response.make_conditional(flask.request)
+
+def send_diagram_file(filename):
+    mimetype = mimetypes.guess_type(filename)[0]
+    
+    for encoding, ext in [('br', '.br'), ('gzip', '.gz')]:
+        if encoding not in flask.request.accept_encodings:
+            continue
+        try:
+            response = flask.send_from_directory(os.path.abspath(diagram_path), filename+ext, mimetype=mimetype)
+        except NotFound:
+            continue
+        response.headers['Content-Encoding'] = encoding
+        return response
+    
+    try:
+        return flask.send_from_directory(os.path.abspath(diagram_path), filename, mimetype=mimetype)
+    except NotFound:
+        return render_diagram_on_demand(filename)
+
+@app.server.route(f'{diagrams_url}<path:filename>')
+def serve_diagram(filename):
+    filename, version = unversioned_filename(filename)
+    response = send_diagram_file(filename)
+    
+    response.headers['Vary'] = 'Accept-Encoding'
+    if version is not None and version == diagram_index.get_version_by_filename(filename):
+        # The url changes with the content
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        # Revalidated with its ETag
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# Diagrams assembled by the browser: the compiled source diagram is sent once, then only the values of 
+# every clicked point (see utilities.diagram_cache.DiagramCache.client_values)
+diagram_client_side = diagram_cache is not None and config.get("diagram_client_side", False)
+
+@app.server.route(f'{diagrams_url}template/<any(light, dark):theme>-<key>.json')
+def serve_diagram_template(theme, key):
+    template = diagram_cache.client_template(theme, key) if diagram_cache is not None else None
+    if template is None:
+        raise NotFound()
+    
+    response = flask.Response(json.dumps(template, separators=(',', ':')), mimetype='application/json')
+    # The key changes with the content, the browser can keep it
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
 
 def create_figure():
     return go.Figure(
@@ -147,7 +249,7 @@ def generate_tooltip_data(pr, cv):
 
 layout = html.Div(
     [
-        html.Div(id='viewport-container'),
+        html.Div(dcc.Store(id='viewport-store'), id='viewport-container'),
         dmc.Container(
             size="lg",
             mt=30,
@@ -372,6 +474,164 @@ def update_pareto(n_clicks, Tamb_str, HR_str, Tv_str, Pth_str, current_theme):
     return [dcc.Graph(figure=fig, id='pareto_front_plot', animate=True, mathjax=True)] #style={'min-width': '400px'}]
 
 
+# Viewport of the client, used to choose the size of the diagram
+clientside_callback(
+    """
+    function(href) {
+        return {'width': window.innerWidth, 'height': window.innerHeight, 'pixel_ratio': window.devicePixelRatio || 1};
+    }
+    """,
+    Output('viewport-store', 'data'),
+    Input('url', 'href')
+)
+
+# Diagram assembled by the browser from the compiled diagram, fetched once per theme and source diagram, and
+# the values of the clicked point. The server rendered diagram is used if the compiled one is not available
+clientside_callback(
+    """
+    async function(params) {
+        if (!params) {
+            return window.dash_clientside.no_update;
+        }
+        
+        window.diagramTemplates = window.diagramTemplates || {};
+        if (!(params.template in window.diagramTemplates)) {
+            window.diagramTemplates[params.template] = fetch(params.template).then(response => {
+                if (!response.ok) { throw new Error(response.statusText); }
+                return response.json();
+            });
+        }
+        
+        let template;
+        try {
+            template = await window.diagramTemplates[params.template];
+        } catch (error) {
+            delete window.diagramTemplates[params.template];
+            return params.fallback;
+        }
+        
+        const parts = [template.chunks[0]];
+        template.slots.forEach((slot, i) => parts.push(params.values[slot], template.chunks[i + 1]));
+        let svg = parts.join('');
+        // Shared assets are referenced relative to the diagrams folder, which an object url does not have
+        if (params.assets_url) {
+            svg = svg.split('"' + params.assets_prefix).join('"' + new URL(params.assets_url, window.location.href).href);
+        }
+        
+        if (window.diagramObjectUrl) {
+            URL.revokeObjectURL(window.diagramObjectUrl);
+        }
+        window.diagramObjectUrl = URL.createObjectURL(new Blob([svg], {type: 'image/svg+xml'}));
+        return window.diagramObjectUrl;
+    }
+    """,
+    Output('client-diagram', 'data'),
+    Input('diagram-params-store', 'data')
+)
+
+def select_thumbnail(diagram_name, viewport):
+    """ Smallest raster thumbnail of the diagram (generate_results.py --thumbnail_widths) that fills the 
+    client viewport, or None if the screen is wider than all of them and the svg should be used """
+    
+    widths = sorted(config.get("diagram_thumbnail_widths", []))
+    if not viewport or not widths:
+        return None
+    
+    required_width = viewport['width'] * viewport.get('pixel_ratio', 1)
+    for width in widths:
+        if width < required_width:
+            continue
+        
+        for fmt in THUMBNAIL_FORMATS:
+            thumbnail_name = thumbnail_filename(diagram_name, width, fmt)
+            try:
+                # Not older than the diagram, otherwise it would show outdated values
+                if os.path.getmtime(os.path.join(diagram_path, thumbnail_name)) >= os.path.getmtime(os.path.join(diagram_path, diagram_name)):
+                    return thumbnail_name
+            except FileNotFoundError:
+                continue
+        break
+        
+    return None
+
+@callback(
+    Output("diagram-container", "children"),
+    Input("diagram-point-store", "data"),
+    State("theme-store", "data"),
+    State("viewport-store", "data"),
+)
+def update_diagram(point, current_theme, viewport=None):
+    """ Diagram of the operation point selected by update_results """
+    
+    if not point: return dash.no_update
+    
+    current_theme = current_theme['colorScheme']
+    opcond_id = point['opcond_id']; ptop_id = point['ptop_id']; caption = point['caption']
+    if opcond_id not in results or ptop_id not in results[opcond_id]:
+        return dash.no_update
+    
+    # Check if the dark version is not available and try the light version instead, unless it can be rendered on demand
+    diagram_theme = current_theme
+    if diagram_theme == 'dark' and diagram_cache is None and not diagram_index.is_available(opcond_id, ptop_id, 'dark'):
+        diagram_theme = 'light'
+    diagram_name = diagram_filename(opcond_id, ptop_id, diagram_theme)
+    diagram_available = diagram_index.is_available(opcond_id, ptop_id, diagram_theme)
+    
+    # Otherwise rendered on demand, tried here once (then kept in the cache) since not every point can be
+    rendered = False
+    if diagram_cache is not None and (diagram_client_side or not diagram_available):
+        rendered = diagram_cache.get(opcond_id, ptop_id, results[opcond_id][ptop_id], theme=diagram_theme) is not None
+        diagram_available = diagram_available or rendered
+        
+    if diagram_client_side and rendered:
+        # The browser joins the values with the compiled diagram it already has (see the clientside callback above)
+        key, values = diagram_cache.client_values(results[opcond_id][ptop_id], theme=current_theme)
+        params = {'template': f'{diagrams_url}template/{current_theme}-{key}.json', 'values': values, 
+                  'fallback': diagram_url(diagram_name)}
+        if config.get("diagram_asset_mode", "embedded") == "shared":
+            params['assets_prefix'] = f'{SHARED_ASSETS_FOLDER}/'
+            params['assets_url'] = f'{diagrams_url}{SHARED_ASSETS_FOLDER}/'
+        diagram = html.Figure([
+            dcc.Store(id='diagram-params-store', data=params),
+            html.ObjectEl(id='client-diagram', type="image/svg+xml", style={"width": "100%"}, children="wascop-diagram"),
+            dmc.Text(caption, align="center", size="sm", color="dimmed")
+        ])
+    elif (not diagram_available and diagram_requests_path and diagram_cache is None and 
+          not is_diagram_failed(diagram_requests_path, f'{opcond_id}_{ptop_id}')):
+        # Not generated yet, the updater renders it before the rest of its batch, or right away if it is idle
+        try:
+            request_diagram(diagram_requests_path, f'{opcond_id}_{ptop_id}')
+            diagram = dmc.Text("Diagram for selected operation point is being generated, click on it again in a few seconds", align="center", my=30, mx=0, weight=700, color='gray')
+        except OSError as e:
+            logging.warning(f'Could not request the diagram for operation point {opcond_id}_{ptop_id}: {e}')
+            diagram = dmc.Text("Diagram not available for selected operation point", align="center", my=30, mx=0, weight=700, color='red')
+    elif not diagram_available:
+        diagram = dmc.Text("Diagram not available for selected operation point", align="center", my=30, mx=0, weight=700, color='red')
+    else:
+        thumbnail_name = select_thumbnail(diagram_name, viewport)
+        if thumbnail_name is not None:
+            # Small screens, a raster image is lighter than the svg
+            diagram = dmc.Image(
+                src=diagram_url(thumbnail_name), alt="wascop-diagram", 
+                caption=caption, width="100%",
+                withPlaceholder=True, placeholder=[dmc.Loader(color="gray", size="sm")]
+            )
+        elif config.get("diagram_asset_mode", "embedded") == "shared":
+            # The diagram references shared asset files, an svg loaded as an image cannot load them
+            diagram = html.Figure([
+                html.ObjectEl(data=diagram_url(diagram_name), type="image/svg+xml", 
+                              style={"width": "100%"}, children="wascop-diagram"),
+                dmc.Text(caption, align="center", size="sm", color="dimmed")
+            ])
+        else:
+            diagram = dmc.Image(
+                src=diagram_url(diagram_name), alt="wascop-diagram", 
+                caption=caption, width="100%",
+                withPlaceholder=True, placeholder=[dmc.Loader(color="gray", size="sm")]
+            ) 
+    
+    return diagram
+
 # Cache this callback
 @callback(
     Output("results_container", "children"),
@@ -415,26 +675,15 @@ def update_results(clickedData, Tamb_str, HR_str, Tv_str, Pth_str, current_theme
     if ptop_id not in results[opcond_id].keys():
         return dash.no_update
     
-    diagram_name = opcond_id+'_'+ptop_id+'.svg' if current_theme=='light' else opcond_id+'_'+ptop_id+'_dark.svg'
-    diagram_path = os.path.join('assets', 'optimization_V1', 'diagrams')
+    caption = f"""Facility diagram with highlighted components and flow paths for cooling requirements: Tv={Tv}ºC and Pth={Pth}kWth,
+    environment conditions: Tamb={Tamb}ºC and HR={HR}% and decision variables: R1={R1}, R2={R2}, Qc={qc} m³/h, Tdc,out={Tdc_out} ºC and Twct,out={Twct_out} ºC."""
     
-    # Check if the dark version is not available and try the light version instead
-    if current_theme == 'dark' and diagram_name not in os.listdir(diagram_path):
-        diagram_name = diagram_name.replace("_dark", "")
-        
-    if diagram_name not in os.listdir(diagram_path):
-        diagram = dmc.Text("Diagram not available for selected operation point", align="center", my=30, mx=0, weight=700, color='red')
-
-
-    else:
-        caption = f"""Facility diagram with highlighted components and flow paths for cooling requirements: Tv={Tv}ºC and Pth={Pth}kWth,
-        environment conditions: Tamb={Tamb}ºC and HR={HR}% and decision variables: R1={R1}, R2={R2}, Qc={qc} m³/h, Tdc,out={Tdc_out} ºC and Twct,out={Twct_out} ºC."""
-        
-        diagram = dmc.Image(
-            src=os.path.join(diagram_path, diagram_name), alt="wascop-diagram", 
-            caption=caption, width="100%",
-            withPlaceholder=True, placeholder=[dmc.Loader(color="gray", size="sm")]
-        ) 
+    # Whether the diagram is available changes while this result is cached, it is selected by 
+    # update_diagram (not cached) once this layout is displayed
+    diagram = html.Div([
+        dcc.Store(id='diagram-point-store', data={'opcond_id': opcond_id, 'ptop_id': ptop_id, 'caption': caption}),
+        html.Div(id='diagram-container'),
+    ], style={"width": "100%"})
     
     # Build plots: comparison bar plot, electrical consumption pie plot, cooling power pie plot
     # Get data
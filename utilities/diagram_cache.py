@@ -0,0 +1,110 @@
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from utilities.diagrams import DiagramTemplate, CompiledDiagram, diagram_values, source_files_mtime, asset_cache, RENDERER_VERSION
+
+""" Diagrams rendered on demand by the web app, for the operation points the batch of the updater
+(generate_results.py) has not rendered yet, or at all if it runs with --no_diagrams. Rendered
+diagrams are kept in memory in a least recently used cache of bounded size """
+
+class DiagramCache:
+    """ Renders the diagram of an operation point the first time it is requested, with the same
+    renderer the updater uses. At most max_bytes of diagrams are kept, the least recently used are
+    dropped first. The source diagram is loaded again if its file, or one of its assets, changes. Operation points that 
+    cannot be rendered (missing or invalid values) are remembered, and only tried again with a new 
+    source diagram or new values.
+    
+    For the diagrams assembled by the browser, the static chunks of the compiled diagram are sent
+    once (client_template) and only the values of the clicked point after that (client_values) """
+
+    def __init__(self, diagram_path, max_bytes=64*1024*1024, precision=None):
+        self.diagram_path = diagram_path
+        self.max_bytes = max_bytes
+        self.precision = precision
+
+        self.template_mtime = None
+        self.renderers = {}
+
+        # (opcond_id, ptop_id, theme, ptop hash) -> svg bytes
+        self.diagrams = OrderedDict()
+        self.n_bytes = 0
+        # Keys of the operation points that could not be rendered
+        self.failed = set()
+        self.lock = threading.Lock()
+
+    def get_renderer(self, theme):
+        mtime = source_files_mtime(self.diagram_path)
+        if mtime != self.template_mtime:
+            template = DiagramTemplate(self.diagram_path)
+            self.renderers = {}
+            self.failed = set()
+            self.template_mtime = mtime
+            self.template = template
+            logging.info(f'Source diagram {self.diagram_path} loaded.')
+
+        if theme not in self.renderers:
+            self.renderers[theme] = CompiledDiagram(self.template, theme=theme, precision=self.precision)
+
+        return self.renderers[theme]
+
+    def get(self, opcond_id, ptop_id, ptop, theme='light'):
+        """ Returns the svg diagram of the operation point as bytes, or None if it cannot be rendered """
+
+        # The content is part of the key, an updated operation point is rendered again
+        ptop_hash = hashlib.sha1(json.dumps(ptop, sort_keys=True).encode('utf-8')).hexdigest()
+        key = (opcond_id, ptop_id, theme, ptop_hash)
+
+        with self.lock:
+            if key in self.diagrams:
+                self.diagrams.move_to_end(key)
+                return self.diagrams[key]
+            # Compiling is not thread safe, and rendering a diagram takes a few milliseconds
+            renderer = self.get_renderer(theme)
+            if key in self.failed:
+                return None
+            
+            try:
+                diagram = renderer.render(ptop)
+            except Exception as e:
+                logging.error(f'Diagram for operation point {opcond_id}_{ptop_id} ({theme}) could not be rendered: {e!r}')
+                self.failed.add(key)
+                return None
+
+            self.diagrams[key] = diagram
+            self.n_bytes += len(diagram)
+            while self.n_bytes > self.max_bytes and len(self.diagrams) > 1:
+                _, dropped = self.diagrams.popitem(last=False)
+                self.n_bytes -= len(dropped)
+
+        logging.info(f'Diagram for operation point {opcond_id}_{ptop_id} ({theme}) rendered on demand.')
+
+        return diagram
+
+    def template_key(self, theme):
+        # Changes whenever the chunks or the values would: source diagram, theme, minification, asset mode or renderer
+        return hashlib.sha1(f'{RENDERER_VERSION}:{self.template.hash}:{theme}:{self.precision}:{asset_cache.shared_folder}'.encode('utf-8')).hexdigest()[:16]
+
+    def client_values(self, ptop, theme='light'):
+        """ Returns the key of the compiled diagram and the values of the operation point, serialized 
+        as in the svg, that the browser joins with the chunks of client_template """
+
+        with self.lock:
+            renderer = self.get_renderer(theme)
+            if renderer.chunks is None:
+                renderer.compile(ptop)
+            values = diagram_values(self.template, ptop, precision=self.precision)
+
+            return self.template_key(theme), [value.decode('utf-8') for value in values]
+
+    def client_template(self, theme, key):
+        """ Returns the static chunks and the slot order of the compiled diagram, or None if key is not 
+        the current one (the source diagram changed, or it was not compiled yet) """
+
+        with self.lock:
+            renderer = self.get_renderer(theme)
+            if renderer.chunks is None or key != self.template_key(theme):
+                return None
+
+            return {'chunks': [chunk.decode('utf-8') for chunk in renderer.chunks], 'slots': renderer.slots}
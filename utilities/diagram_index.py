@@ -0,0 +1,138 @@
+import os
+import re
+import json
+import logging
+import threading
+
+""" Generated diagrams as known by the web app, from the diagrams folder and the manifest the updater
+(generate_results.py) keeps next to it: {diagram filename: key}. The key changes whenever the inputs
+of a diagram (operation point, source diagram, theme, output options, renderer) do, so it is used as
+the version of its content in the diagram urls """
+
+DIAGRAMS_MANIFEST_FILENAME = 'diagrams_manifest.json'
+
+# <opcond_id>_<ptop_id>.svg or <opcond_id>_<ptop_id>_dark.svg
+DIAGRAM_FILENAME_PATTERN = re.compile(r'(.*?)_(R1.*?)(_dark)?\.svg')
+# Thumbnails, <diagram filename without .svg>.<width>w.<format> (see utilities.diagrams.thumbnail_filename)
+THUMBNAIL_FILENAME_PATTERN = re.compile(r'(.*)\.\d+w\.[a-z]+')
+# <filename without extension>.<version>.<extension>
+VERSIONED_FILENAME_PATTERN = re.compile(r'(.*)\.([0-9a-f]{16})(\.[^.]+)')
+VERSION_LENGTH = 16
+
+def parse_diagram_filename(filename):
+    """ Returns (opcond_id, ptop_id, theme) of a diagram filename, or None """
+
+    match = DIAGRAM_FILENAME_PATTERN.fullmatch(filename)
+    if match is None:
+        return None
+
+    opcond_id, ptop_id, dark = match.groups()
+    return opcond_id, ptop_id, 'dark' if dark else 'light'
+
+def diagram_filename(opcond_id, ptop_id, theme='light'):
+    return f'{opcond_id}_{ptop_id}{"_dark" if theme == "dark" else ""}.svg'
+
+def versioned_filename(filename, version):
+    base, ext = os.path.splitext(filename)
+    return f'{base}.{version}{ext}'
+
+def unversioned_filename(filename):
+    """ Returns the filename without its version and the version, None if it has none """
+
+    match = VERSIONED_FILENAME_PATTERN.fullmatch(filename)
+    if match is None:
+        return filename, None
+
+    return match.group(1) + match.group(3), match.group(2)
+
+def source_diagram_filename(filename):
+    # Thumbnails share the version of their diagram
+    match = THUMBNAIL_FILENAME_PATTERN.fullmatch(filename)
+    return f'{match.group(1)}.svg' if match else filename
+
+class DiagramIndex:
+    """ Generated diagrams known by the web app: which are available, {(opcond_id, ptop_id, theme)}, and 
+    their versions, (opcond_id, ptop_id, theme) -> version. The diagrams folder is only listed once, 
+    then the index is updated from the manifest when it changes, which the updater does every few 
+    diagrams and at the end of every batch. A diagram not in the index yet is looked up on its own """
+
+    def __init__(self, diagrams_folder, manifest_path):
+        self.diagrams_folder = diagrams_folder
+        self.manifest_path = manifest_path
+        self.manifest_mtime = None
+        self.versions = {}
+        self.available = None
+        self.lock = threading.Lock()
+
+    def scan(self):
+        available = set()
+        try:
+            with os.scandir(self.diagrams_folder) as entries:
+                for entry in entries:
+                    diagram_id = parse_diagram_filename(entry.name)
+                    if diagram_id is not None:
+                        available.add(diagram_id)
+        except FileNotFoundError:
+            logging.warning(f'Diagrams folder {self.diagrams_folder} not found.')
+
+        logging.info(f'Diagrams folder {self.diagrams_folder} indexed ({len(available)} diagrams).')
+        return available
+
+    def refresh(self):
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+
+        if mtime == self.manifest_mtime and self.available is not None:
+            return
+
+        with self.lock:
+            if self.available is None:
+                self.available = self.scan()
+            if mtime == self.manifest_mtime:
+                return
+
+            versions = {}
+            if mtime is not None:
+                try:
+                    with open(self.manifest_path, 'r') as file:
+                        manifest = json.load(file)
+                except (FileNotFoundError, json.JSONDecodeError) as e:
+                    # Replaced while reading it, it is read again on the next access
+                    logging.warning(f'Diagrams manifest {self.manifest_path} could not be read: {e}')
+                    return
+
+                for filename, key in manifest.items():
+                    diagram_id = parse_diagram_filename(filename)
+                    if diagram_id is not None:
+                        versions[diagram_id] = key[:VERSION_LENGTH]
+
+            # Diagrams are written before they are added to the manifest
+            self.available.update(versions.keys())
+            self.versions = versions
+            self.manifest_mtime = mtime
+            logging.info(f'Diagrams manifest {self.manifest_path} loaded ({len(versions)} diagrams).')
+
+    def is_available(self, opcond_id, ptop_id, theme='light'):
+        self.refresh()
+        diagram_id = (opcond_id, ptop_id, theme)
+        if diagram_id in self.available:
+            return True
+
+        # Generated after the manifest was last saved, or not by the updater
+        if os.path.exists(os.path.join(self.diagrams_folder, diagram_filename(opcond_id, ptop_id, theme))):
+            self.available.add(diagram_id)
+            return True
+
+        return False
+
+    def get_version(self, opcond_id, ptop_id, theme='light'):
+        self.refresh()
+        return self.versions.get((opcond_id, ptop_id, theme))
+
+    def get_version_by_filename(self, filename):
+        """ Version of a diagram or of one of its thumbnails, None if it is not known """
+
+        diagram_id = parse_diagram_filename(source_diagram_filename(filename))
+        return self.get_version(*diagram_id) if diagram_id is not None else None
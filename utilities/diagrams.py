@@ -0,0 +1,865 @@
+import os
+import math
+import io
+import re
+import hashlib
+import base64
+import logging
+from copy import deepcopy
+import numpy as np
+from lxml import etree
+
+try:
+    # Raster thumbnails, optional
+    import cairosvg
+except (ImportError, OSError):
+    # OSError if the cairo library is not installed
+    cairosvg = None
+
+try:
+    # Thumbnails as webp instead of png, optional
+    from PIL import Image
+except ImportError:
+    Image = None
+
+""" Generation of the facility diagram of an operation point from the source svg diagram """
+
+nsmap = {
+    'sodipodi': 'http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd',
+    'cc': 'http://web.resource.org/cc/',
+    'svg': 'http://www.w3.org/2000/svg',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+    'xlink': 'http://www.w3.org/1999/xlink',
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'inkscape': 'http://www.inkscape.org/namespaces/inkscape'
+    }
+
+# Líneas
+lineas = ["line_c_in", "line_c_out", "line_r1", "line_dc_in", "line_dc_out",
+          "line_r2_out1", "line_r2_out2", "line_wct_in", "line_wct_out", "line_pump_in"]
+
+# Iconos
+iconos = ["cost_e_dc", "cost_e_wct", "cost_w_wct", "cooling_req", "fan_dc", 
+          "fan_wct", "temp_amb", "hr_amb", "temp_dc", "temp_wct", "valve_r1",
+          "valve_r2"]
+
+# Cuadros de texto
+textos = ["line_c_in_text", "line_c_out_text", "pump_c_text"]
+
+# Objects that must exist in the source diagram
+required_objects = lineas + iconos + textos + ['Twct_in', 'qwct', 'qdc', 'background-image', 'logo-gobierno', 
+                                               'logo-psa', 'titulo', 'subtitulo']
+
+# Symbols legend box, not all of them exist
+legend_objects = [f'juWprjBz31KtaNW54uK3-{i}' for i in range(28, 57)]
+
+# Increase when a change in this module changes the generated diagrams, so cached ones are rendered again
+RENDERER_VERSION = 1
+
+class DiagramTemplate:
+    """ Source svg diagram, parsed and validated once. For every cell-* group it keeps the path
+    (child indices from the root) that leads to it, so the cells of a copy of the diagram are
+    found without searching the whole document """
+    
+    def __init__(self, diagram_path):
+        self.diagram_path = diagram_path
+        # Assets (icons, backgrounds, logos) are next to the source diagram
+        self.assets_folder = os.path.dirname(diagram_path)
+        
+        with open(diagram_path, 'rb') as f:
+            content = f.read()
+        # Identifies the version of the source diagram and its assets, part of the cache key of the generated diagrams
+        sha1 = hashlib.sha1(content)
+        for filename in asset_filenames:
+            try:
+                with open(os.path.join(self.assets_folder, filename), 'rb') as f:
+                    sha1.update(f'{filename}:'.encode('utf-8') + hashlib.sha1(f.read()).digest())
+            except FileNotFoundError:
+                # Only fails once a diagram uses it
+                sha1.update(f'{filename}:missing'.encode('utf-8'))
+        self.hash = sha1.hexdigest()
+        self.diagram = etree.parse(io.BytesIO(content))
+            
+        self.cell_paths = {}
+        self.index_cells(self.diagram.getroot(), ())
+        # Cells of the template itself, must only be read
+        self.cells = self.resolve_cells(self.diagram)
+        
+        missing_objects = [object_ for object_ in required_objects if object_ not in self.cell_paths]
+        if missing_objects:
+            raise ValueError(f'Objects {missing_objects} not found in diagram {diagram_path}')
+        
+    def index_cells(self, element, path):
+        for idx, child in enumerate(element):
+            if child.tag == f'{{{nsmap["svg"]}}}g':
+                id_ = child.get('id', '')
+                # Keep the first one, as the previous xpath search did
+                if id_.startswith('cell-') and id_[len('cell-'):] not in self.cell_paths:
+                    self.cell_paths[id_[len('cell-'):]] = path + (idx,)
+            self.index_cells(child, path + (idx,))
+        
+    def resolve_cells(self, diagram):
+        root = diagram.getroot()
+        
+        cells = {}
+        for object_id, path in self.cell_paths.items():
+            element = root
+            for idx in path:
+                element = element[idx]
+            cells[object_id] = element
+            
+        return cells
+            
+    def copy(self):
+        """ Returns a copy of the diagram and a dict object_id -> cell element of that copy """
+        
+        diagram = deepcopy(self.diagram)
+            
+        return diagram, self.resolve_cells(diagram)
+
+class TreeWriter:
+    """ Sets the values of an operation point in the elements of a copy of the diagram """
+    
+    def set(self, element, attribute, value):
+        element.set(attribute, value)
+        
+    def set_text(self, element, text):
+        element.text = text
+        
+    def insert_before(self, element, markup):
+        element.addprevious(etree.fromstring(markup))
+
+class SlotWriter:
+    """ Sets numbered placeholders instead of the values, used to compile the diagram """
+    
+    def __init__(self):
+        self.n_slots = 0
+        
+    def placeholder(self):
+        self.n_slots += 1
+        return f'@@slot{self.n_slots-1}@@'
+    
+    def set(self, element, attribute, value):
+        element.set(attribute, self.placeholder())
+        
+    def set_text(self, element, text):
+        element.text = self.placeholder()
+        
+    def insert_before(self, element, markup):
+        element.addprevious(etree.Comment(self.placeholder()))
+
+class ValueWriter:
+    """ Only collects the values, serialized, in the order they are set. The elements are not modified.
+    If precision is given, the values are minified as minify does with the rest of the diagram """
+    
+    def __init__(self, precision=None):
+        self.precision = precision
+        self.values = []
+        
+    def set(self, element, attribute, value):
+        if self.precision is not None:
+            value = round_numbers(attribute, value, self.precision)
+        self.values.append(escape_attribute(value))
+        
+    def set_text(self, element, text):
+        self.values.append(escape_text(text))
+        
+    def insert_before(self, element, markup):
+        self.values.append(serialize_markup(markup, self.precision))
+    
+# Diagram generation auxiliary functions
+def round_to_nonzero_decimal(n):
+    if n == 0:
+        return 0
+    sgn = -1 if n < 0 else 1
+    scale = int(-math.floor(math.log10(abs(n))))
+    if scale <= 0:
+        scale = 1
+    factor = 10**scale
+    return sgn*math.floor(abs(n)*factor)/factor
+
+
+def convert_to_float_if_possible(value):
+    try:
+        converted_value = float(value)
+        return converted_value
+    except ValueError:
+        return value
+
+def change_text(writer, cell, new_text):
+    for child in cell:
+        if child.tag.endswith('g'):
+            for child2 in child:
+                if child2.tag.endswith('text'):
+                    writer.set_text(child2, new_text)
+                    break
+
+def get_y(x, xmin, xmax, ymin, ymax):
+    return ((ymax - ymin) / (xmax - xmin)) * (x - xmin) + ymin
+
+def icon_label(value, unit):
+    if unit=='degree_celsius': unit= '⁰C'
+    
+    if type(value) == str:
+        return f'{value} {unit}'
+    elif type(value) == int:
+        return f'{value} {unit}'
+    else:
+        return f'{round_to_nonzero_decimal(value)} {unit}'
+
+def adjust_icon(writer, id, size, tag, label, include_boundary=True, max_size=None, max_value=None):
+    
+    for child in tag[0]:
+        # Adjust icon size
+        if 'image' in child.tag:
+            pos_x = child.get("x"); pos_y = child.get("y")
+            current_size = float(child.get("width"))
+            delta_size = size - current_size
+            
+            writer.set(child, "width", str(size))
+            writer.set(child, "height", str(size))
+            
+            pos_x = float(pos_x)-delta_size/2
+            pos_y = float(pos_y)-delta_size/2
+            
+            writer.set(child, "x", str(pos_x))
+            writer.set(child, "y", str(pos_y))
+            
+            # Add template-id property to be used later
+            writer.set(child, "template-id", f'icon-{id}')
+            
+        # Add text
+        if child.tag.endswith('g'):
+            for child2 in child:
+                if 'text' in child2.tag:
+                    writer.set_text(child2, label)
+                    
+    # Add boundary circle
+    if include_boundary:
+        writer.insert_before(tag[0][0], generate_boundary_circle(id, size, max_size, max_value, pos_x, pos_y))
+    return tag, pos_x, pos_y
+
+def generate_boundary_circle(id, size_icon, size_boundary, max_value, pos_x, pos_y):
+    
+    x = pos_x + size_icon/2
+    y = pos_y + size_icon/2
+    
+    return f"""
+    <g id="boundary-{id}">
+        <ellipse cx="{x}" cy="{y}" rx="{size_boundary/2}" ry="{size_boundary/2}" fill-opacity="0" fill="rgb(255, 255, 255)" stroke="#ececec" stroke-dasharray="3 3" pointer-events="all"/>
+        <g fill="#ECECEC" font-family="Helvetica" font-size="10px">
+        <text x="{x+size_boundary/2}" y="{y}">{max_value:.0f}</text></g></g>
+    """
+
+def get_level(value, min_value, max_value):
+    span = max_value - min_value
+    if value < min_value + span/3:
+        level = 1
+    elif value < min_value + 2*span/3:
+        level = 2
+    else:
+        level = 3
+    return level
+
+def change_color_text(writer, cell, text_color):
+    for child in cell:
+        # print(child.tag)
+        if child.tag.endswith('g'):
+            # In multiline text, the color is set in the group tag
+            writer.set(child, 'fill', text_color)
+            for child_ in child:
+                # print(child_.tag)
+                if 'text' in child_.tag:
+                    writer.set(child_, 'fill', text_color)
+
+# Folder, inside the diagrams folder, with the shared copies of the image assets
+SHARED_ASSETS_FOLDER = 'assets'
+
+class AssetCache:
+    """ Image assets referenced by the diagrams, every file is read and encoded once. An entry is 
+    read again if the modification time or size of its file changes.
+    
+    By default the assets are embedded in every diagram as data URLs. If shared_folder is set, a
+    copy named after its content is kept there and the diagrams reference it with a path relative
+    to the diagrams folder instead """
+    
+    def __init__(self, shared_folder=None):
+        self.shared_folder = shared_folder
+        # image_path -> ((mtime, size), href)
+        self.entries = {}
+        
+    def href(self, image_path):
+        stat = os.stat(image_path)
+        version = (stat.st_mtime_ns, stat.st_size, self.shared_folder)
+        
+        entry = self.entries.get(image_path)
+        if entry is None or entry[0] != version:
+            with open(image_path, 'rb') as file:
+                binary_fc = file.read()  # fc aka file_content
+            
+            ext = image_path.split('.')[-1]
+            if self.shared_folder is None:
+                entry = (version, data_url(binary_fc, ext))
+            else:
+                entry = (version, self.share(binary_fc, ext))
+            self.entries[image_path] = entry
+            logging.debug(f'Asset {image_path} loaded ({len(binary_fc)} bytes).')
+            
+        return entry[1]
+    
+    def share(self, content, ext):
+        # Named after its content, an existing copy is never modified
+        filename = f'{hashlib.sha1(content).hexdigest()[:16]}.{ext}'
+        path = os.path.join(self.shared_folder, filename)
+        if not os.path.exists(path):
+            os.makedirs(self.shared_folder, exist_ok=True)
+            tmp_path = f'{path}.tmp-{os.getpid()}'
+            with open(tmp_path, 'wb') as file:
+                file.write(content)
+            os.replace(tmp_path, path)
+            
+        return f'{SHARED_ASSETS_FOLDER}/{filename}'
+
+asset_cache = AssetCache()
+
+def data_url(content, ext):
+    base64_utf8_str = base64.b64encode(content).decode('utf-8')
+    
+    if ext == 'svg': ext = 'svg+xml'
+    return f'data:image/{ext};base64,{base64_utf8_str}'
+
+def update_image(writer, cell, image_path):
+
+    href = asset_cache.href(image_path)
+
+    for child in cell:
+        if 'image' in child.tag:
+            writer.set(child, '{http://www.w3.org/1999/xlink}href', href)
+
+def share_embedded_images(writer, diagram):
+    """ With shared assets, moves the images still embedded in the diagram (those of the source 
+    diagram that are not replaced) to the shared folder """
+    
+    if asset_cache.shared_folder is None:
+        return
+    
+    for element in diagram.getroot().iter(f'{{{nsmap["svg"]}}}image'):
+        href = element.get(f'{{{nsmap["xlink"]}}}href', '')
+        match = re.match(r'data:image/([\w+.-]+);base64,', href)
+        if match is None:
+            continue
+        
+        ext = {'svg+xml': 'svg', 'jpeg': 'jpg'}.get(match.group(1), match.group(1))
+        writer.set(element, f'{{{nsmap["xlink"]}}}href', asset_cache.share(base64.b64decode(href[match.end():]), ext))
+
+def generate_diagram(template, ptop, theme='light'):
+    """ Returns a copy of the template diagram updated with the values of the operation point """
+    
+    diagram, cells = template.copy()
+    writer = TreeWriter()
+    update_geometry(writer, cells, ptop, template.assets_folder)
+    apply_theme(writer, cells, template.assets_folder, theme)
+    share_embedded_images(writer, diagram)
+    
+    return diagram
+
+# Geometry parameters
+line_c_min = 10
+line_c_max = 15
+
+min_size = 30
+max_size = 70
+
+# Icons sized after a variable: (icon_id, var_id, group, unit, include boundary)
+sized_icons = [("fan_dc", "w_fan_dc", "control_variables", "%", True),
+               ("fan_wct", "w_fan_wct", "control_variables", "%", True),
+               ("valve_r1", "R1", "decision_variables", "", False),
+               ("valve_r2", "R2", "decision_variables", "", False),
+               ("temp_amb", "Tamb", "environment", "degree_celsius", True),
+               ("hr_amb", "HR", "environment", "%", True),
+               ("temp_wct", "Twct_out", "decision_variables", "degree_celsius", True),
+               ("temp_dc", "Tdc_out", "decision_variables", "degree_celsius", True)]
+
+# Costs icons, the image depends on the level of the cost: (icon_id, var_id, image, unit, min value, max value)
+# Costes máximos y mínimos obtenidos a partir de resultados de optimización
+cost_icons = [("cost_e_wct", "Ce_wct", "electrical_consumption", "kWhe", "Ce_min", "Ce_max"),
+              ("cost_e_dc", "Ce_dc", "electrical_consumption", "kWhe", "Ce_min", "Ce_max"),
+              ("cost_w_wct", "Cw_wct", "water_consumption", "L/h", None, "Cw_max")]
+
+# Images replaced by the dark theme: (object_id, filename)
+dark_theme_images = [("background-image", "background_dark.jpg"),
+                     ("logo-gobierno", "micin-uefeder-aei_letras_blancas.svg"),
+                     ("logo-psa", "logo_psa_letras_blancas_sin_fondo.svg")]
+
+# Image files the diagrams use, next to the source diagram
+asset_filenames = ([f'{image}_x{level}.svg' for image in sorted({image for _, _, image, _, _, _ in cost_icons}) for level in (1, 2, 3)] +
+                   [filename for _, filename in dark_theme_images])
+
+def source_files_mtime(diagram_path):
+    """ Modification times of the source diagram and its assets, changes if any of them does """
+    
+    mtimes = []
+    for path in [diagram_path] + [os.path.join(os.path.dirname(diagram_path), filename) for filename in asset_filenames]:
+        try:
+            mtimes.append(os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            mtimes.append(None)
+    return tuple(mtimes)
+
+# Text boxes and additional variables: (object_id, var_id, group, unit)
+text_objects = [("line_c_in_text", "Tc_in", "others", "°C"),
+                ("line_c_out_text", "Tc_out", "others", "°C"),
+                ("pump_c_text", "qc", "decision_variables", "m3/h"),
+                ("Twct_in", "Twct_in", "others", "°C"),
+                ("qwct", "m_wct", "others", "m³/h"),
+                ("qdc", "m_dc", "others", "m³/h")]
+
+def line_widths_record(line_width, width_line_r1, width_line_dc, width_r2_out1, width_line_r2_out2):
+    return {"line_pump_in": line_width, "line_c_in": line_width, "line_c_out": line_width,
+            "line_r1": width_line_r1,
+            "line_dc_in": width_line_dc, "line_dc_out": width_line_dc,
+            "line_r2_out1": width_r2_out1,
+            "line_r2_out2": width_line_r2_out2,
+            "line_wct_in": width_line_r1 + width_line_r2_out2, "line_wct_out": width_line_r1 + width_line_r2_out2}
+
+def cooling_req_label(ptop):
+    cr = ptop["cooling_requirements"]
+    return icon_label(f'{cr["Pth"]:.0f} kWhth, {cr["Mv"]:.2f} kg/s, {cr["Tv"]:.0f} ⁰C', '')
+
+def geometry_params(ptop):
+    """ Geometric and label parameters of an operation point: line widths, icon sizes and labels,
+    cost levels and texts. batch_geometry_params computes the same for many points at once """
+    
+    # Define some short names
+    op_r = ptop["operating_range"]
+    dv = ptop["decision_variables"]
+    
+    # Modificar grosor de líneas
+    line_width = get_y(dv["qc"], op_r["qc_min"], op_r["qc_max"], line_c_min, line_c_max)
+    width_line_r1 = line_width*(dv["R1"])
+    width_line_dc = line_width*(1-dv["R1"])
+    width_r2_out1 = width_line_dc*(1-dv["R2"])
+    width_line_r2_out2 = width_line_dc*(dv["R2"])
+    
+    # Modificar tamaño de iconos
+    icons = {}
+    for icon_id, var_id, group, unit, boundary in sized_icons:
+        size = get_y(ptop[group][var_id], op_r[var_id+'_min'], op_r[var_id+'_max'], min_size, max_size)
+        icons[icon_id] = {'id': var_id, 'size': size, 'label': icon_label(convert_to_float_if_possible(ptop[group][var_id]), unit),
+                          'boundary': boundary, 'max_value': op_r[var_id+'_max']}
+        
+    # Cooling requirements
+    size = get_y(ptop["cooling_requirements"]['Pth'], op_r['Pth_min'], op_r['Pth_max'], min_size, max_size)
+    icons['cooling_req'] = {'id': 'cooling_req', 'size': size, 'label': cooling_req_label(ptop), 
+                            'boundary': True, 'max_value': op_r['Pth_max']}
+    
+    costs = {}
+    for icon_id, var_id, image, unit, min_id, max_id in cost_icons:
+        value = ptop['costs'][var_id]
+        level = get_level(value, op_r[min_id] if min_id else 0, op_r[max_id])
+        costs[icon_id] = {'id': var_id, 'image': f'{image}_x{level}.svg', 'label': icon_label(value, unit)}
+        
+    texts = {object_id: f'{round_to_nonzero_decimal(ptop[group][var_id])} {unit}' for object_id, var_id, group, unit in text_objects}
+    
+    return {'line_widths': line_widths_record(line_width, width_line_r1, width_line_dc, width_r2_out1, width_line_r2_out2),
+            'icons': icons, 'costs': costs, 'texts': texts}
+
+# Values read by batch_geometry_params: (group, var_id)
+batch_fields = ([("decision_variables", "R1"), ("decision_variables", "R2"), ("decision_variables", "qc"),
+                 ("operating_range", "qc_min"), ("operating_range", "qc_max"), ("operating_range", "Pth_min"), ("operating_range", "Pth_max"),
+                 ("cooling_requirements", "Pth"), ("cooling_requirements", "Mv"), ("cooling_requirements", "Tv")] +
+                [field for icon_id, var_id, group, unit, boundary in sized_icons 
+                 for field in [(group, var_id), ("operating_range", var_id+'_min'), ("operating_range", var_id+'_max')]] +
+                [field for icon_id, var_id, image, unit, min_id, max_id in cost_icons 
+                 for field in [('costs', var_id), ("operating_range", max_id)] + ([("operating_range", min_id)] if min_id else [])] +
+                [(group, var_id) for object_id, var_id, group, unit in text_objects])
+
+def has_numeric_fields(ptop):
+    try:
+        return all(type(ptop[group][var_id]) in (int, float) for group, var_id in batch_fields)
+    except (KeyError, TypeError):
+        return False
+
+# Powers of ten exactly representable as floats
+exact_powers_of_ten = np.array([float(10**k) for k in range(23)])
+
+def batch_round_to_nonzero_decimal(values):
+    """ round_to_nonzero_decimal of a list of numbers, returns a list """
+    
+    n = np.array(values, dtype=float)
+    abs_n = np.abs(n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log = np.log10(abs_n)
+        scale = -np.floor(log)
+        scale[scale <= 0] = 1
+        
+        # Computed one by one: zeros and non finite values, logarithms close to an integer (np.log10 
+        # could differ in the last bit from math.log10), and products or powers of ten not exact as floats
+        scalar = ~np.isfinite(log) | (np.abs(log - np.round(log)) < 1e-9) | (scale >= len(exact_powers_of_ten))
+        factor = exact_powers_of_ten[np.where(scalar, 0, scale).astype(int)]
+        scalar |= abs_n*factor >= 2**53
+        
+        rounded = (np.sign(n) * (np.floor(abs_n*factor) / factor)).tolist()
+        
+    for idx in np.flatnonzero(scalar).tolist():
+        rounded[idx] = round_to_nonzero_decimal(values[idx])
+        
+    return rounded
+
+def batch_icon_labels(values, unit):
+    """ icon_label of a list of numbers """
+    
+    rounded = batch_round_to_nonzero_decimal(values)
+    if unit=='degree_celsius': unit= '⁰C'
+    
+    return [f'{value} {unit}' if type(value) == int else f'{rounded_value} {unit}' for value, rounded_value in zip(values, rounded)]
+
+def batch_get_level(value, min_value, max_value):
+    span = max_value - min_value
+    return np.where(value < min_value + span/3, 1, np.where(value < min_value + 2*span/3, 2, 3))
+
+def batch_geometry_params(ptops):
+    """ geometry_params of a list of operation points (e.g. all the points of an operating condition).
+    The variables are gathered in arrays and the line widths, icon sizes, cost levels and rounded 
+    labels are computed with numpy in one pass, the records are the same geometry_params returns. 
+    The record of a point for which geometry_params would fail (e.g. an empty operating range) is None """
+    
+    # Points with a missing or non numeric value are left to geometry_params, which fails for that point only
+    checked = [idx for idx, ptop in enumerate(ptops) if has_numeric_fields(ptop)]
+    checked_ptops = [ptops[idx] for idx in checked]
+    
+    params = [None] * len(ptops)
+    if not checked_ptops:
+        return params
+    
+    with np.errstate(all='ignore'):
+        for idx, record in zip(checked, batch_geometry_records(checked_ptops)):
+            params[idx] = record
+            
+    return params
+    
+def batch_geometry_records(ptops):
+    def values(group, var_id):
+        return [ptop[group][var_id] for ptop in ptops]
+    
+    def column(group, var_id):
+        return np.array(values(group, var_id), dtype=float)
+    
+    # Modificar grosor de líneas
+    R1 = column("decision_variables", "R1"); R2 = column("decision_variables", "R2")
+    line_width = get_y(column("decision_variables", "qc"), column("operating_range", "qc_min"), column("operating_range", "qc_max"), line_c_min, line_c_max)
+    width_line_r1 = line_width*R1
+    width_line_dc = line_width*(1-R1)
+    width_r2_out1 = width_line_dc*(1-R2)
+    width_line_r2_out2 = width_line_dc*R2
+    line_widths = np.stack([line_width, width_line_r1, width_line_dc, width_r2_out1, width_line_r2_out2], axis=1)
+    valid = np.isfinite(line_widths).all(axis=1)
+    line_widths = line_widths.tolist()
+    
+    # Modificar tamaño de iconos
+    icon_sizes = {}; icon_labels = {}
+    for icon_id, var_id, group, unit, boundary in sized_icons:
+        x = column(group, var_id)
+        sizes = get_y(x, column("operating_range", var_id+'_min'), column("operating_range", var_id+'_max'), min_size, max_size)
+        valid &= np.isfinite(sizes)
+        icon_sizes[icon_id] = sizes.tolist()
+        icon_labels[icon_id] = batch_icon_labels(x.tolist(), unit)
+        
+    sizes = get_y(column("cooling_requirements", 'Pth'), column("operating_range", 'Pth_min'), column("operating_range", 'Pth_max'), min_size, max_size)
+    valid &= np.isfinite(sizes)
+    icon_sizes['cooling_req'] = sizes.tolist()
+    
+    cost_levels = {}; cost_labels = {}
+    for icon_id, var_id, image, unit, min_id, max_id in cost_icons:
+        cost_values = values('costs', var_id)
+        cost_levels[icon_id] = batch_get_level(np.array(cost_values, dtype=float), column("operating_range", min_id) if min_id else 0, 
+                                               column("operating_range", max_id)).tolist()
+        cost_labels[icon_id] = batch_icon_labels(cost_values, unit)
+        
+    texts = {object_id: [f'{value} {unit}' for value in batch_round_to_nonzero_decimal(values(group, var_id))]
+             for object_id, var_id, group, unit in text_objects}
+    
+    params = []
+    for idx, ptop in enumerate(ptops):
+        if not valid[idx]:
+            # Division by zero in get_y, left to geometry_params
+            params.append(None)
+            continue
+        
+        op_r = ptop["operating_range"]
+        
+        icons = {icon_id: {'id': var_id, 'size': icon_sizes[icon_id][idx], 'label': icon_labels[icon_id][idx],
+                           'boundary': boundary, 'max_value': op_r[var_id+'_max']}
+                 for icon_id, var_id, group, unit, boundary in sized_icons}
+        icons['cooling_req'] = {'id': 'cooling_req', 'size': icon_sizes['cooling_req'][idx], 'label': cooling_req_label(ptop), 
+                                'boundary': True, 'max_value': op_r['Pth_max']}
+        
+        costs = {icon_id: {'id': var_id, 'image': f'{image}_x{cost_levels[icon_id][idx]}.svg', 'label': cost_labels[icon_id][idx]}
+                 for icon_id, var_id, image, unit, min_id, max_id in cost_icons}
+        
+        params.append({'line_widths': line_widths_record(*line_widths[idx]), 'icons': icons, 'costs': costs,
+                       'texts': {object_id: labels[idx] for object_id, labels in texts.items()}})
+        
+    return params
+
+def update_geometry(writer, cells, ptop, folder_path, params=None):
+    """ Theme independent stage: sets the values of the operation point (line widths, icon sizes, texts,
+    cost icons) in the cells of the diagram through writer. The elements that are set, and the order
+    in which they are, only depend on the template. params, from geometry_params, are computed if not given """
+    
+    if params is None:
+        params = geometry_params(ptop)
+    
+    # Objects to update in diagram, wrapped in a list as returned by xpath
+    tags = {object_: [cells[object_]] for object_ in lineas + iconos + textos}
+        
+    # Línea y flecha
+    for line, width in params['line_widths'].items():
+        for child in tags[line][0]:
+            writer.set(child, "stroke-width", str(width))
+    
+    # Modificar tamaño de iconos y añadir template-id para texto
+    for icon_id, icon in params['icons'].items():
+        adjust_icon(writer, icon['id'], icon['size'], tags[icon_id], icon['label'], 
+                    include_boundary=icon['boundary'], max_size=max_size, max_value=icon['max_value'])
+        
+    # Costs icons and text values
+    for icon_id, cost in params['costs'].items():
+        update_image(writer, cells[icon_id], os.path.join(folder_path, cost['image']))
+        adjust_icon(writer, cost['id'], 70, tags[icon_id], cost['label'], include_boundary=False, max_size=None, max_value=None)
+        
+    # Añadir valores para cuadros de texto
+    for object_id, text in params['texts'].items():
+        if object_id in textos:
+            for child in cells[object_id]:
+                if child.tag.endswith('g'):
+                    for child2 in child:
+                        if 'text' in child2.tag:
+                            writer.set_text(child2, text)
+        else:
+            # Change text for additional variables
+            change_text(writer, cells[object_id], text)
+    
+def apply_theme(writer, cells, folder_path, theme='light'):
+    """ Theme overlay stage, independent of the operation point """
+    
+    # Change background depending on theme
+    if theme=='dark':
+        
+        # Background image and logos
+        for object_id, filename in dark_theme_images:
+            update_image(writer, cells[object_id], os.path.join(folder_path, filename))
+        
+        # Symbols legend box
+        for object_id in legend_objects:
+            if object_id not in cells:
+                continue
+            symbols_obj = [cells[object_id]]
+            
+            # print(symbols_obj[0].attrib)
+
+            for child in symbols_obj[0]:
+                # print(child.tag)
+                
+                # Update background color
+                if 'rect' in child.tag and len(symbols_obj[0]) == 1:
+                    # print('changing background of legend box')
+                    writer.set(child, 'fill', '#333333')
+                    writer.set(child, 'stroke', '#ECECEC')
+                    
+                    
+                # Change text color
+                if 'g' in child.tag and not 'rect' in child.tag:
+                    for child_ in child:
+                        if 'text' in child_.tag:
+                            writer.set(child_, 'fill', '#ECECEC')
+               
+        # Title
+        change_color_text(writer, cells['titulo'], text_color='#ECECEC')
+
+        # Subtitle
+        change_color_text(writer, cells['subtitulo'], text_color='#ECECEC')
+
+# Compiled diagrams
+SLOT_PATTERN = re.compile(rb'<!--@@slot(\d+)@@-->|@@slot(\d+)@@')
+
+# Same escaping as libxml2 when serializing to ascii
+def escape_text(text):
+    text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('\r', '&#13;')
+    return text.encode('ascii', 'xmlcharrefreplace')
+
+def escape_attribute(value):
+    value = value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+    value = value.replace('\n', '&#10;').replace('\r', '&#13;').replace('\t', '&#9;')
+    return value.encode('ascii', 'xmlcharrefreplace')
+
+def serialize_markup(markup, precision=None):
+    element = etree.fromstring(markup)
+    if precision is not None:
+        minify(element, precision)
+    return etree.tostring(element)
+
+def diagram_values(template, ptop, params=None, precision=None):
+    """ Geometry stage of the compiled diagrams: the serialized values of the operation point """
+    
+    writer = ValueWriter(precision)
+    update_geometry(writer, template.cells, ptop, template.assets_folder, params)
+    
+    return writer.values
+
+class CompiledDiagram:
+    """ Diagram of a theme compiled into static byte chunks separated by slots (stroke widths, icon
+    positions and sizes, texts, hrefs, boundary circles). The theme overlay is part of the chunks.
+    Rendering an operation point only computes the slot values and joins them with the chunks, the 
+    result is byte-identical to serializing generate_diagram(template, ptop, theme). Compiled on the 
+    first render. If precision is given the diagram is minified (see minify) """
+    
+    def __init__(self, template, theme='light', precision=None):
+        self.template = template
+        self.theme = theme
+        self.precision = precision
+        self.chunks = None
+        # Bytes of the static part removed by the minification
+        self.saved_bytes = 0
+        
+    def compile(self, ptop):
+        # Any operation point is valid, only the placeholders end up in the diagram
+        diagram, cells = self.template.copy()
+        update_geometry(SlotWriter(), cells, ptop, self.template.assets_folder)
+        apply_theme(TreeWriter(), cells, self.template.assets_folder, self.theme)
+        share_embedded_images(TreeWriter(), diagram)
+        
+        content = etree.tostring(diagram)
+        if self.precision is not None:
+            minify(diagram.getroot(), self.precision)
+            # Without the comments before the root element
+            minified_content = etree.tostring(diagram.getroot())
+            self.saved_bytes = len(content) - len(minified_content)
+            content = minified_content
+        
+        parts = SLOT_PATTERN.split(content)
+        self.chunks = parts[0::3]
+        # Value indices in document order. A value set twice to the same attribute only keeps the last slot
+        self.slots = [int(markup_idx or idx) for markup_idx, idx in zip(parts[1::3], parts[2::3])]
+        
+        logging.debug(f'Compiled {self.theme} diagram: {len(self.chunks)} chunks, {len(self.slots)} slots.')
+        
+    def render(self, ptop, values=None):
+        """ Returns the svg diagram of the operation point as bytes. values, from diagram_values, can 
+        be shared by the renderers of every theme """
+        
+        if self.chunks is None:
+            self.compile(ptop)
+            
+        if values is None:
+            values = diagram_values(self.template, ptop, precision=self.precision)
+        
+        output = [self.chunks[0]]
+        for idx, chunk in zip(self.slots, self.chunks[1:]):
+            output.append(values[idx])
+            output.append(chunk)
+            
+        return b''.join(output)
+
+# Minification
+EDITOR_NAMESPACES = [nsmap['sodipodi'], nsmap['inkscape']]
+
+# Elements whose text is content, whitespace in them is kept
+TEXT_ELEMENTS = ['text', 'tspan', 'textPath', 'title', 'desc', 'style', 'flowRoot', 'flowPara', 'flowSpan', 'foreignObject']
+
+# Attributes whose numbers are rounded
+NUMERIC_ATTRIBUTES = ['x', 'y', 'width', 'height', 'cx', 'cy', 'r', 'rx', 'ry', 'x1', 'y1', 'x2', 'y2', 
+                      'stroke-width', 'd', 'points', 'transform', 'viewBox']
+
+# Numbers with decimals, optionally with an exponent (those are left as they are)
+NUMBER_PATTERN = re.compile(r'-?\d*\.\d+(?:[eE][-+]?\d+)?')
+
+def round_number(number, precision):
+    if 'e' in number or 'E' in number:
+        return number
+    
+    rounded = f'{float(number):.{precision}f}'
+    if '.' in rounded:
+        rounded = rounded.rstrip('0').rstrip('.')
+    return '0' if rounded == '-0' else rounded
+
+def round_numbers(attribute, value, precision):
+    if attribute not in NUMERIC_ATTRIBUTES:
+        return value
+    return NUMBER_PATTERN.sub(lambda match: round_number(match.group(0), precision), value)
+
+def local_name(element):
+    return etree.QName(element).localname if isinstance(element.tag, str) else None
+
+def remove_element(element):
+    # Keeps its tail text
+    parent = element.getparent()
+    if element.tail:
+        previous = element.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or '') + element.tail
+        else:
+            parent.text = (parent.text or '') + element.tail
+    parent.remove(element)
+
+def minify(root, precision=3):
+    """ Strips editor (sodipodi, inkscape) elements and attributes, metadata, comments and whitespace
+    between elements, and rounds the numbers of geometric attributes to precision decimals. The
+    placeholders of a diagram being compiled are kept """
+    
+    for element in list(root.iter()):
+        if element is root:
+            continue
+        
+        if element.tag is etree.Comment:
+            if not element.text.startswith('@@slot'):
+                remove_element(element)
+        elif element.tag is etree.PI:
+            remove_element(element)
+        elif isinstance(element.tag, str) and (local_name(element) == 'metadata' or etree.QName(element).namespace in EDITOR_NAMESPACES):
+            remove_element(element)
+            
+    def minify_element(element, keep_whitespace):
+        for attribute in list(element.attrib):
+            if etree.QName(attribute).namespace in EDITOR_NAMESPACES:
+                del element.attrib[attribute]
+            else:
+                value = element.get(attribute)
+                rounded = round_numbers(attribute, value, precision)
+                if rounded != value:
+                    element.set(attribute, rounded)
+                
+        keep_whitespace = keep_whitespace or local_name(element) in TEXT_ELEMENTS
+        if not keep_whitespace and element.text is not None and not element.text.strip():
+            element.text = None
+            
+        for child in element:
+            if not keep_whitespace and child.tail is not None and not child.tail.strip():
+                child.tail = None
+            if isinstance(child.tag, str):
+                minify_element(child, keep_whitespace)
+                
+    minify_element(root, False)
+    etree.cleanup_namespaces(root)
+
+# Raster thumbnails
+THUMBNAIL_FORMATS = ['webp', 'png']
+THUMBNAIL_FORMAT = 'webp' if Image is not None else 'png'
+
+def thumbnail_filename(diagram_filename, width, fmt=THUMBNAIL_FORMAT):
+    # e.g. <ptop_id>_dark.svg -> <ptop_id>_dark.480w.webp
+    return f'{diagram_filename[:-len(".svg")]}.{width}w.{fmt}'
+
+def render_thumbnail(diagram, width, url=None):
+    """ Raster copy of the diagram (svg bytes) width pixels wide, webp if Pillow is installed and png
+    otherwise. url, the path of the diagram, is used to resolve relative references (shared assets) """
+    
+    png = cairosvg.svg2png(bytestring=diagram, url=url, output_width=width)
+    if Image is None:
+        return png
+    
+    with Image.open(io.BytesIO(png)) as image:
+        output = io.BytesIO()
+        image.save(output, format='WEBP', quality=80)
+        
+    return output.getvalue()
@@ -0,0 +1,129 @@
+import os
+import heapq
+import logging
+import itertools
+import threading
+
+""" Priority queue of the diagrams the updater (generate_results.py) has to render. The web app asks
+for the diagram of a clicked operation point by leaving a request file in the requests folder of
+the results (<results folder>/diagram_requests/<opcond_id>_<ptop_id>.request), the updater moves
+those points to the front of the queue and the rest of the batch continues behind them. Points
+requested while no batch runs are rendered on their own. Points that fail to render are reported
+back in the same folder (<opcond_id>_<ptop_id>.failed), so the app stops waiting for them """
+
+DIAGRAM_REQUESTS_FOLDER = 'diagram_requests'
+REQUEST_EXTENSION = '.request'
+FAILED_EXTENSION = '.failed'
+
+# Priorities, lower first
+REQUESTED = 0
+BATCH = 1
+
+def request_diagram(requests_folder, ptop_id):
+    """ Called by the web app, asks the updater to render the diagram of <opcond_id>_<ptop_id> first """
+
+    os.makedirs(requests_folder, exist_ok=True)
+    # Empty, the name is the request. Requesting it again only updates its modification time
+    with open(os.path.join(requests_folder, f'{ptop_id}{REQUEST_EXTENSION}'), 'wb'):
+        pass
+
+def pop_diagram_requests(requests_folder):
+    """ Returns the requested ptop_ids, oldest first, and removes their request files """
+
+    try:
+        filenames = [filename for filename in os.listdir(requests_folder) if filename.endswith(REQUEST_EXTENSION)]
+    except FileNotFoundError:
+        return []
+
+    requests = []
+    for filename in filenames:
+        path = os.path.join(requests_folder, filename)
+        try:
+            requests.append((os.stat(path).st_mtime, filename[:-len(REQUEST_EXTENSION)]))
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+
+    return [ptop_id for _, ptop_id in sorted(requests)]
+
+def is_diagram_request(path, requests_folder):
+    return os.path.dirname(os.path.abspath(path)) == os.path.abspath(requests_folder) and path.endswith(REQUEST_EXTENSION)
+
+def report_failed_diagram(requests_folder, ptop_id):
+    """ Called by the updater, the diagram of <opcond_id>_<ptop_id> could not be rendered """
+
+    os.makedirs(requests_folder, exist_ok=True)
+    with open(os.path.join(requests_folder, f'{ptop_id}{FAILED_EXTENSION}'), 'wb'):
+        pass
+
+def clear_failed_diagram(requests_folder, ptop_id):
+    try:
+        os.remove(os.path.join(requests_folder, f'{ptop_id}{FAILED_EXTENSION}'))
+    except FileNotFoundError:
+        pass
+
+def failed_diagrams(requests_folder):
+    """ ptop_ids of the points whose diagram could not be rendered """
+
+    try:
+        return {filename[:-len(FAILED_EXTENSION)] for filename in os.listdir(requests_folder) if filename.endswith(FAILED_EXTENSION)}
+    except FileNotFoundError:
+        return set()
+
+def is_diagram_failed(requests_folder, ptop_id):
+    return os.path.exists(os.path.join(requests_folder, f'{ptop_id}{FAILED_EXTENSION}'))
+
+class RenderQueue:
+    """ Items are popped in order of priority, then in the order they were pushed. Requested items
+    are popped most recent request first: the last clicked point is the one being looked at """
+
+    def __init__(self):
+        self.heap = []
+        # ptop_id -> heap entry, [sort key, item, removed]
+        self.entries = {}
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def push(self, ptop_id, item, priority=BATCH):
+        with self.lock:
+            self.push_entry(ptop_id, item, priority)
+
+    def push_entry(self, ptop_id, item, priority):
+        count = next(self.counter)
+        entry = [(priority, -count if priority == REQUESTED else count), ptop_id, item, False]
+        self.entries[ptop_id] = entry
+        heapq.heappush(self.heap, entry)
+
+    def bump(self, ptop_id):
+        """ Moves a queued item to the front. Returns False if it is not queued (already popped or unknown) """
+
+        with self.lock:
+            entry = self.entries.get(ptop_id)
+            if entry is None:
+                return False
+
+            # The old entry stays in the heap, marked as removed, and is skipped when popped
+            entry[-1] = True
+            self.push_entry(ptop_id, entry[2], REQUESTED)
+            return True
+
+    def pop(self):
+        """ Returns the (ptop_id, item) with the highest priority, or None if the queue is empty """
+
+        with self.lock:
+            while self.heap:
+                _, ptop_id, item, removed = heapq.heappop(self.heap)
+                if not removed:
+                    del self.entries[ptop_id]
+                    return ptop_id, item
+            return None
+
+    def bump_requested(self, requests_folder):
+        """ Moves the points requested by the web app to the front """
+
+        for ptop_id in pop_diagram_requests(requests_folder):
+            if self.bump(ptop_id):
+                logging.info(f'Diagram for operation point {ptop_id} requested, moved to the front of the queue.')
+
+    def __len__(self):
+        return len(self.entries)
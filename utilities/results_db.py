@@ -0,0 +1,119 @@
+import os
+import json
+import sqlite3
+import logging
+
+""" SQLite index of the optimization results: one row per operation point with indexed columns for
+the environment, cooling requirements, decision variables and costs, so range queries can be made
+without loading the results. Built by generate_results.py, a local file next to the results """
+
+DB_FILENAME = 'results.sqlite'
+
+# Column name -> (ptop group, variable)
+COLUMNS = {
+    'Tamb': ('environment', 'Tamb'),
+    'HR': ('environment', 'HR'),
+    'Tv': ('cooling_requirements', 'Tv'),
+    'Pth': ('cooling_requirements', 'Pth'),
+    'Mv': ('cooling_requirements', 'Mv'),
+    'R1': ('decision_variables', 'R1'),
+    'R2': ('decision_variables', 'R2'),
+    'qc': ('decision_variables', 'qc'),
+    'Tdc_out': ('decision_variables', 'Tdc_out'),
+    'Twct_out': ('decision_variables', 'Twct_out'),
+    'w_fan_dc': ('control_variables', 'w_fan_dc'),
+    'w_fan_wct': ('control_variables', 'w_fan_wct'),
+    'Ce': ('costs', 'Ce'),
+    'Cw': ('costs', 'Cw'),
+    'Ce_dc': ('costs', 'Ce_dc'),
+    'Ce_wct': ('costs', 'Ce_wct'),
+    'Ce_c': ('costs', 'Ce_c'),
+    'Cw_wct': ('costs', 'Cw_wct'),
+}
+
+INDEXES = {
+    'idx_environment': ['Tamb', 'HR'],
+    'idx_cooling_requirements': ['Tv', 'Pth'],
+    'idx_decision_variables': ['R1', 'R2', 'qc'],
+    'idx_Ce': ['Ce'],
+    'idx_Cw': ['Cw'],
+}
+
+def create_tables(connection):
+    columns = ', '.join(f'{column} REAL' for column in COLUMNS)
+    connection.execute(f'CREATE TABLE IF NOT EXISTS operating_points (opcond_id TEXT NOT NULL, optpt_id TEXT NOT NULL, '
+                       f'{columns}, ptop TEXT NOT NULL, PRIMARY KEY (opcond_id, optpt_id))')
+    for index_name, index_columns in INDEXES.items():
+        connection.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON operating_points ({", ".join(index_columns)})')
+
+def point_row(opcond_id, optpt_id, ptop):
+    values = []
+    for group, var_id in COLUMNS.values():
+        value = ptop.get(group, {}).get(var_id)
+        values.append(value if isinstance(value, (int, float)) else None)
+
+    return (opcond_id, optpt_id, *values, json.dumps(ptop, separators=(',', ':')))
+
+def insert_sql():
+    return (f'INSERT OR REPLACE INTO operating_points (opcond_id, optpt_id, {", ".join(COLUMNS)}, ptop) '
+            f'VALUES ({", ".join(["?"] * (len(COLUMNS) + 3))})')
+
+def rebuild_db(db_path, data):
+    """ Builds the database from scratch in a temporary file that then replaces the current one """
+
+    tmp_path = f'{db_path}.tmp-{os.getpid()}'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    connection = sqlite3.connect(tmp_path)
+    try:
+        with connection:
+            create_tables(connection)
+            connection.executemany(insert_sql(), (point_row(opcond_id, optpt_id, ptop)
+                                                  for opcond_id, ptops in data.items() for optpt_id, ptop in ptops.items()))
+    finally:
+        connection.close()
+
+    # Rollback journal (the default) so no journal files are left behind that could be mixed with the new file
+    os.replace(tmp_path, db_path)
+    logging.info(f'Database {db_path} rebuilt.')
+
+def update_db(db_path, records):
+    """ Applies the changes in the results log records (see results_store.append_to_log) in a single transaction """
+
+    connection = sqlite3.connect(db_path)
+    try:
+        with connection:
+            create_tables(connection)
+            # In order, the same point could be changed more than once
+            for record in records:
+                if record['op'] == 'put':
+                    connection.execute(insert_sql(), point_row(record['opcond_id'], record['optpt_id'], record['ptop']))
+                else:
+                    connection.execute('DELETE FROM operating_points WHERE opcond_id = ? AND optpt_id = ?',
+                                       (record['opcond_id'], record['optpt_id']))
+    finally:
+        connection.close()
+
+    logging.info(f'Database {db_path} updated with {len(records)} changes.')
+
+def query_points(db_path, where='1', params=(), columns=None, include_ptop=False):
+    """ Returns the operation points matching the where clause as a list of dicts, e.g.
+    query_points(db_path, 'Cw < ? AND Tamb = ?', (50, 30)) """
+
+    columns = list(columns or COLUMNS.keys())
+    selected = ['opcond_id', 'optpt_id'] + columns + (['ptop'] if include_ptop else [])
+
+    # Read only, the database is only written by the updater
+    connection = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    try:
+        rows = connection.execute(f'SELECT {", ".join(selected)} FROM operating_points WHERE {where}', params).fetchall()
+    finally:
+        connection.close()
+
+    points = [dict(zip(selected, row)) for row in rows]
+    if include_ptop:
+        for point in points:
+            point['ptop'] = json.loads(point['ptop'])
+
+    return points
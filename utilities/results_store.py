@@ -0,0 +1,334 @@
+import os
+import json
+import hashlib
+import time
+import logging
+import threading
+from collections.abc import Mapping
+
+""" Results store: the optimization results are split in one shard per operating condition
+(opcond_id, e.g. Tamb20_HR40_Tv45_Pth200). Every generation of results is published as an
+immutable snapshot (an index of shards) and a pointer to the current snapshot is atomically
+replaced. Changes made after a snapshot are appended to its log (one JSON record per line) 
+until they are compacted into a new snapshot. Written by generate_results.py and read by the web app """
+
+CURRENT_FILENAME = 'current.json'
+SNAPSHOTS_FOLDER = 'snapshots'
+SHARDS_FOLDER = 'shards'
+LOG_FOLDER = 'log'
+
+def atomic_write(path, content):
+    # Write to a temporary file in the same folder and rename it, readers either see the
+    # old or the new file but never a partially written one
+    tmp_path = f'{path}.tmp-{os.getpid()}'
+    with open(tmp_path, 'wb') as file:
+        file.write(content)
+    os.replace(tmp_path, path)
+
+def dump_json(obj):
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+def log_path(results_folder_path, generation):
+    return os.path.join(results_folder_path, LOG_FOLDER, f'{generation:08d}.ndjson')
+
+def append_to_log(results_folder_path, generation, records):
+    """ Appends records to the log of the given snapshot generation. Records are either
+    {'op': 'put', 'opcond_id', 'optpt_id', 'ptop'} or {'op': 'del', 'opcond_id', 'optpt_id'} """
+    
+    os.makedirs(os.path.join(results_folder_path, LOG_FOLDER), exist_ok=True)
+    
+    # A single write, readers ignore a trailing line that is not complete yet
+    with open(log_path(results_folder_path, generation), 'ab') as file:
+        file.write(b''.join(dump_json(record) + b'\n' for record in records))
+
+def read_log(path, offset=0):
+    """ Reads the complete records of a log starting at offset. Returns them and the offset 
+    where the next read should start """
+    try:
+        with open(path, 'rb') as file:
+            file.seek(offset)
+            content = file.read()
+    except FileNotFoundError:
+        return [], offset
+    
+    end = content.rfind(b'\n') + 1
+    records = [json.loads(line) for line in content[:end].splitlines() if line]
+    
+    return records, offset + end
+
+def apply_log_record(data, record):
+    opcond_id = record['opcond_id']; optpt_id = record['optpt_id']
+    
+    if record['op'] == 'put':
+        data.setdefault(opcond_id, {})[optpt_id] = record['ptop']
+    elif opcond_id in data:
+        data[opcond_id].pop(optpt_id, None)
+        if not data[opcond_id]:
+            del data[opcond_id]
+
+def load_results(results_folder_path):
+    """ Loads the complete results (current snapshot plus its log). Returns them, the snapshot
+    generation, the number of records in its log and the operating conditions they change, or 
+    None if nothing has been published yet """
+    
+    snapshot = load_current(results_folder_path)
+    if snapshot is None:
+        return None
+    
+    data = {}
+    for opcond_id, entry in snapshot['index'].items():
+        with open(os.path.join(results_folder_path, entry['shard']), mode='r', encoding='utf-8') as file:
+            data[opcond_id] = json.load(file)
+            
+    records, _ = read_log(log_path(results_folder_path, snapshot['generation']))
+    for record in records:
+        apply_log_record(data, record)
+        
+    return data, snapshot['generation'], len(records), {record['opcond_id'] for record in records}
+
+def load_current(results_folder_path):
+    """ Returns the current snapshot ({'generation': n, 'index': {opcond_id: entry}}), or None if
+    nothing has been published yet """
+    try:
+        with open(os.path.join(results_folder_path, CURRENT_FILENAME), mode='r', encoding='utf-8') as file:
+            current = json.load(file)
+        with open(os.path.join(results_folder_path, current['snapshot']), mode='r', encoding='utf-8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+def publish_snapshot(results_folder_path, data, changed_opcond_ids=None, snapshots_to_keep=5):
+    """ Publishes a new generation of results. Only the shards of the operating conditions that
+    changed are written (all of them if changed_opcond_ids is None), the rest are shared with the
+    previous snapshot. Snapshots older than the last snapshots_to_keep, and the shards only they
+    reference, are removed """
+
+    shards_path = os.path.join(results_folder_path, SHARDS_FOLDER)
+    snapshots_path = os.path.join(results_folder_path, SNAPSHOTS_FOLDER)
+    os.makedirs(shards_path, exist_ok=True)
+    os.makedirs(snapshots_path, exist_ok=True)
+
+    previous = load_current(results_folder_path) or {'generation': 0, 'index': {}}
+    if changed_opcond_ids is None:
+        index = {}
+        changed_opcond_ids = set(data.keys())
+    else:
+        index = dict(previous['index'])
+
+    for opcond_id in changed_opcond_ids:
+        if opcond_id not in data:
+            index.pop(opcond_id, None)
+            continue
+
+        # Shards are immutable, named after their content
+        content = dump_json(data[opcond_id])
+        digest = hashlib.sha1(content).hexdigest()
+        shard = f'{SHARDS_FOLDER}/{opcond_id}.{digest[:16]}.json'
+        if not os.path.exists(os.path.join(results_folder_path, shard)):
+            atomic_write(os.path.join(results_folder_path, shard), content)
+
+        index[opcond_id] = {'shard': shard, 'n_points': len(data[opcond_id]), 'hash': digest}
+
+    generation = previous['generation'] + 1
+    snapshot = f'{SNAPSHOTS_FOLDER}/{generation:08d}.json'
+    atomic_write(os.path.join(results_folder_path, snapshot), dump_json({'generation': generation, 'index': index}))
+    atomic_write(os.path.join(results_folder_path, CURRENT_FILENAME), dump_json({'generation': generation, 'snapshot': snapshot}))
+
+    logging.info(f'Published results snapshot {generation}: {len(changed_opcond_ids)} shards updated, {len(index)} operating conditions.')
+
+    remove_old_snapshots(results_folder_path, snapshots_to_keep)
+
+    return generation
+
+def remove_old_snapshots(results_folder_path, snapshots_to_keep):
+    # The snapshot just published is always kept
+    snapshots_to_keep = max(snapshots_to_keep, 1)
+    snapshots_path = os.path.join(results_folder_path, SNAPSHOTS_FOLDER)
+    shards_path = os.path.join(results_folder_path, SHARDS_FOLDER)
+
+    snapshots = sorted(f for f in os.listdir(snapshots_path) if f.endswith('.json'))
+    old_snapshots = snapshots[:-snapshots_to_keep]
+    if not old_snapshots:
+        return
+
+    for snapshot in old_snapshots:
+        os.remove(os.path.join(snapshots_path, snapshot))
+        
+        # Its log was already compacted into the following snapshots
+        generation = int(snapshot[:-len('.json')])
+        if os.path.exists(log_path(results_folder_path, generation)):
+            os.remove(log_path(results_folder_path, generation))
+
+    # Shards still referenced by a retained snapshot are kept
+    referenced_shards = set()
+    for snapshot in snapshots[-snapshots_to_keep:]:
+        with open(os.path.join(snapshots_path, snapshot), mode='r', encoding='utf-8') as file:
+            referenced_shards.update(os.path.basename(entry['shard']) for entry in json.load(file)['index'].values())
+
+    removed_shards = [f for f in os.listdir(shards_path) if f.endswith('.json') and f not in referenced_shards]
+    for shard in removed_shards:
+        os.remove(os.path.join(shards_path, shard))
+
+    logging.info(f'Removed {len(old_snapshots)} old snapshots and {len(removed_shards)} unreferenced shards.')
+
+class ResultsStore(Mapping):
+    """ Read-only mapping opcond_id -> {ptop_id: ptop} that loads each shard on first access.
+    A new snapshot published by the updater is picked up on the next access and only the shards
+    that changed are dropped, new records in the snapshot log are replayed on top of the shards.
+    If the results folder has no snapshot, the monolithic results.json is loaded instead. Shared by
+    the request threads of the app, every access holds the lock """
+
+    def __init__(self, results_folder_path, refresh_interval=1.0):
+        self.results_folder_path = results_folder_path
+        # Seconds during which the snapshot and its log are not checked again
+        self.refresh_interval = refresh_interval
+        self.last_refresh = None
+        self.current_path = os.path.join(results_folder_path, CURRENT_FILENAME)
+
+        self.index = {}
+        self.current_mtime = None
+        self.generation = None
+        self.shards = {}
+        
+        # Changes from the log of the current snapshot: {opcond_id: {optpt_id: ptop or None if deleted}}
+        self.log_offset = 0
+        self.log_changes = {}
+        # Shards with the log changes applied
+        self.merged_shards = {}
+        # Reentrant, refresh is also called while loading a shard
+        self.lock = threading.RLock()
+
+        self.refresh()
+
+    def load_monolithic(self):
+        results_path = os.path.join(self.results_folder_path, 'results.json')
+        logging.warning(f'No results snapshot found in {self.results_folder_path}, loading {results_path}')
+
+        with open(results_path, mode="r", encoding='utf-8') as file:
+            self.shards = json.loads(file.read())
+        self.index = {opcond_id: {'n_points': len(ptops)} for opcond_id, ptops in self.shards.items()}
+
+    def refresh(self, force=False):
+        with self.lock:
+            # A single callback accesses the store many times
+            now = time.monotonic()
+            if not force and self.last_refresh is not None and now - self.last_refresh < self.refresh_interval:
+                return
+            self.last_refresh = now
+
+            self.refresh_snapshot(force)
+
+    def refresh_snapshot(self, force=False):
+        try:
+            mtime = os.stat(self.current_path).st_mtime
+        except FileNotFoundError:
+            if self.current_mtime is None and not self.index:
+                self.load_monolithic()
+            return
+
+        if mtime == self.current_mtime and not force:
+            self.refresh_log()
+            return
+
+        snapshot = load_current(self.results_folder_path)
+        if snapshot is None:
+            # Pointer replaced while reading it, will be picked up on the next access
+            return
+
+        for opcond_id in list(self.shards.keys()):
+            if snapshot['index'].get(opcond_id, {}).get('hash') != self.index.get(opcond_id, {}).get('hash'):
+                del self.shards[opcond_id]
+
+        self.index = snapshot['index']
+        self.generation = snapshot['generation']
+        self.current_mtime = mtime
+        
+        # The log of the previous snapshot is already compacted in the new one
+        self.log_offset = 0
+        self.log_changes = {}
+        self.merged_shards = {}
+        self.refresh_log()
+        
+    def refresh_log(self):
+        path = log_path(self.results_folder_path, self.generation)
+        try:
+            if os.stat(path).st_size <= self.log_offset:
+                return
+        except FileNotFoundError:
+            return
+
+        records, self.log_offset = read_log(path, self.log_offset)
+        
+        for record in records:
+            opcond_id = record['opcond_id']
+            self.log_changes.setdefault(opcond_id, {})[record['optpt_id']] = record['ptop'] if record['op'] == 'put' else None
+            self.merged_shards.pop(opcond_id, None)
+
+    def load_shard(self, opcond_id):
+        shard_path = os.path.join(self.results_folder_path, self.index[opcond_id]['shard'])
+        with open(shard_path, mode="r", encoding='utf-8') as file:
+            return json.load(file)
+
+    def __getitem__(self, opcond_id):
+        with self.lock:
+            self.refresh()
+            shard = self.get_merged_shard(opcond_id)
+            # Every point of the condition was deleted by the log, as apply_log_record does
+            if not shard:
+                raise KeyError(opcond_id)
+            return shard
+
+    def get_merged_shard(self, opcond_id):
+        if opcond_id not in self.log_changes:
+            return self.get_shard(opcond_id)
+        
+        if opcond_id not in self.merged_shards:
+            merged = dict(self.get_shard(opcond_id)) if opcond_id in self.index else {}
+            for optpt_id, ptop in self.log_changes[opcond_id].items():
+                if ptop is None:
+                    merged.pop(optpt_id, None)
+                else:
+                    merged[optpt_id] = ptop
+            self.merged_shards[opcond_id] = merged
+            
+        return self.merged_shards[opcond_id]
+    
+    def get_shard(self, opcond_id):
+        if opcond_id not in self.shards:
+            if opcond_id not in self.index:
+                raise KeyError(opcond_id)
+
+            try:
+                self.shards[opcond_id] = self.load_shard(opcond_id)
+            except FileNotFoundError:
+                # The snapshot this index belongs to was already removed, use the current one
+                self.refresh(force=True)
+                if opcond_id not in self.index:
+                    raise KeyError(opcond_id)
+                self.shards[opcond_id] = self.load_shard(opcond_id)
+
+        return self.shards[opcond_id]
+
+    def has_points(self, opcond_id):
+        if opcond_id not in self.log_changes:
+            return opcond_id in self.index
+        return len(self.get_merged_shard(opcond_id)) > 0
+
+    def opcond_ids(self):
+        opcond_ids = list(self.index.keys()) + [opcond_id for opcond_id in self.log_changes if opcond_id not in self.index]
+        return [opcond_id for opcond_id in opcond_ids if self.has_points(opcond_id)]
+
+    def __contains__(self, opcond_id):
+        with self.lock:
+            self.refresh()
+            return self.has_points(opcond_id)
+
+    def __iter__(self):
+        with self.lock:
+            self.refresh()
+            return iter(self.opcond_ids())
+
+    def __len__(self):
+        with self.lock:
+            self.refresh()
+            return len(self.opcond_ids())